@@ -1,14 +1,20 @@
 import os
+import asyncio
+import functools
 import logging
+import random
 import time
+import threading
 from decimal import Decimal
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter
 from supabase import create_client, Client
 import re
 from web3 import Web3
 import json
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -68,8 +74,50 @@ GROUPS_KEYBOARD = ReplyKeyboardMarkup([
     ['🔙 Back to Menu']
 ], resize_keyboard=True)
 
-# User states
-user_states = {}
+# Static messages (built once at import)
+JOIN_GROUPS_MSG = (
+    "📢 Join ALL these groups to participate:\n\n"
+    "1️⃣ [MetaCore Airdrop Chat](https://t.me/MetaAirdropchat)\n"
+    "2️⃣ [MetaCore Airdrop News](https://t.me/metaairdropnews)\n"
+    "3️⃣ [Bot News](https://t.me/botnewz1)\n\n"
+    "⚠️ You must join ALL groups!\n"
+    "After joining, click the button below:"
+)
+
+SET_WALLET_MSG = (
+    "💳 Set Your BSC Wallet Address\n\n"
+    "⚠️ Send your MetaCore (BEP-20) wallet address\n"
+    "⚠️ Must start with 0x and be 42 characters\n"
+    "⚠️ Double-check - wrong address = lost tokens!\n\n"
+    "Example: 0x742d35Cc6634C0532925a3b8D4C0C8b3C2e1e1e1\n\n"
+    "🔗 BSC Testnet Network Details:\n"
+    "• Network Name: BSC Testnet\n"
+    "• RPC URL: https://data-seed-prebsc-1-s1.binance.org:8545/\n"
+    "• Chain ID: 97\n"
+    "• Symbol: tBNB\n"
+    "• Block Explorer: https://testnet.bscscan.com"
+)
+
+HELP_MSG = (
+    "❓ MetaCore Airdrop Help\n\n"
+    "🎯 How to earn:\n"
+    "• Join groups: +500 MetaCore\n"
+    "• Refer friends: +4000 MetaCore each\n\n"
+    "💸 Withdrawal:\n"
+    "• Minimum: 4000 MetaCore\n"
+    "• Set BSC wallet first\n"
+    "• Admin approval required\n"
+    "• Network: BSC Testnet\n\n"
+    "🔗 BSC Testnet Setup:\n"
+    "• RPC: https://data-seed-prebsc-1-s1.binance.org:8545/\n"
+    "• Chain ID: 97\n"
+    "• Symbol: tBNB\n\n"
+    "🔗 Support: @your_support_username"
+)
+
+# User states (idle sessions expire so the map stays bounded)
+USER_STATE_TTL = 1800
+user_states = TTLCache(maxsize=100_000, ttl=USER_STATE_TTL)
 
 class UserState:
     MAIN = "main"
@@ -79,19 +127,30 @@ class UserState:
     SETTING_WALLET = "setting_wallet"
     WITHDRAWING = "withdrawing"
 
+# Maximum number of updates processed at the same time
+CONCURRENT_UPDATES = 256
+
 # Anti-spam and security features
-user_last_action = {}
 RATE_LIMIT_SECONDS = 2
+# Entries expire once the rate-limit window has passed
+user_last_action = TTLCache(maxsize=100_000, ttl=RATE_LIMIT_SECONDS)
 
 def rate_limit_check(user_id):
     """Check if user is rate limited"""
-    now = time.time()
     if user_id in user_last_action:
-        if now - user_last_action[user_id] < RATE_LIMIT_SECONDS:
-            return False
-    user_last_action[user_id] = now
+        return False
+    user_last_action[user_id] = time.time()
     return True
 
+def admin_only(handler):
+    """Silently ignore the command unless it comes from the admin"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id != ADMIN_ID:
+            return
+        return await handler(update, context)
+    return wrapper
+
 def escape_markdown_v2(text):
     """Escape special characters for Markdown V2"""
     if text is None:
@@ -99,35 +158,121 @@ def escape_markdown_v2(text):
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return ''.join(f'\\{char}' if char in escape_chars else char for char in str(text))
 
+# Caches for hot read paths (cache-aside, invalidated on writes)
+SETTINGS_CACHE_TTL = 300
+# Past this fraction of the TTL, callers start refreshing settings early
+SETTINGS_EARLY_REFRESH = 0.8
+USER_CACHE_TTL = 30
+_settings_entry = None  # (settings, fetched_at)
+_settings_refresh_lock = threading.Lock()
+_user_cache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+# Helpers below run in worker threads (see db_execute), so guard the caches
+_cache_lock = threading.Lock()
+
+DEFAULT_SETTINGS = {
+    'signup_bonus': 1000,
+    'referral_bonus': 4000,
+    'group_join_bonus': 500,
+    'min_withdraw_amount': 4000
+}
+
+# Short-lived caches for Web3 reads shown in /network
+_chain_cache = TTLCache(maxsize=2, ttl=5)
+_admin_bnb_cache = TTLCache(maxsize=1, ttl=30)
+
+# Broadcast pacing: one status edit per batch, bounded concurrent sends, and a
+# send rate under Telegram's ~30 messages/second bot limit
+BROADCAST_BATCH_SIZE = 500
+BROADCAST_CONCURRENCY = 25
+BROADCAST_RATE = 25
+BROADCAST_MAX_ATTEMPTS = 3
+
+class SendPacer:
+    """Spaces sends at least 1/max_per_sec apart, and lets a flood-wait pause every sender"""
+    
+    def __init__(self, max_per_sec):
+        self.interval = 1 / max_per_sec
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    def pause(self, seconds):
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+def invalidate_user(user_id):
+    """Drop a cached user row after it has been written to"""
+    with _cache_lock:
+        _user_cache.pop(user_id, None)
+
+def invalidate_settings():
+    """Drop the cached settings row after it has been written to"""
+    global _settings_entry
+    _settings_entry = None
+
 # Helper functions
+async def db_execute(query):
+    """Run a Supabase query in a worker thread so the event loop keeps serving updates"""
+    return await asyncio.to_thread(query.execute)
+
 def get_user(user_id):
+    with _cache_lock:
+        user = _user_cache.get(user_id)
+    if user is not None:
+        return user
     try:
         result = supabase.table('users').select('*').eq('id', user_id).execute()
-        return result.data[0] if result.data else None
+        user = result.data[0] if result.data else None
+        if user:
+            # numeric columns come back as strings; convert once here
+            user['balance'] = float(user.get('balance') or 0)
+            with _cache_lock:
+                _user_cache[user_id] = user
+        return user
     except Exception as e:
         logger.error(f"Error getting user {user_id}: {e}")
         return None
 
-def get_settings():
+def fetch_settings(stale=None):
+    """Load settings from the database and refresh the cache"""
+    global _settings_entry
     try:
         result = supabase.table('settings').select('*').execute()
-        if result.data:
-            return result.data[0]
-        else:
-            return {
-                'signup_bonus': 1000,
-                'referral_bonus': 4000,
-                'group_join_bonus': 500,
-                'min_withdraw_amount': 4000
-            }
+        settings = result.data[0] if result.data else dict(DEFAULT_SETTINGS)
+        _settings_entry = (settings, time.monotonic())
+        return settings
     except Exception as e:
         logger.error(f"Error getting settings: {e}")
-        return {
-            'signup_bonus': 1000,
-            'referral_bonus': 4000,
-            'group_join_bonus': 500,
-            'min_withdraw_amount': 4000
-        }
+        return stale if stale is not None else dict(DEFAULT_SETTINGS)
+
+def get_settings():
+    entry = _settings_entry
+    if entry is not None:
+        settings, fetched_at = entry
+        age = (time.monotonic() - fetched_at) / SETTINGS_CACHE_TTL
+        if age < 1:
+            # Probabilistic early refresh: the closer to expiry, the likelier one
+            # caller refreshes ahead of time while everyone else keeps the cached row
+            chance = (age - SETTINGS_EARLY_REFRESH) / (1 - SETTINGS_EARLY_REFRESH)
+            if random.random() < chance and _settings_refresh_lock.acquire(blocking=False):
+                try:
+                    return fetch_settings(stale=settings)
+                finally:
+                    _settings_refresh_lock.release()
+            return settings
+    
+    # Expired or empty: single-flight so only one caller hits the database
+    with _settings_refresh_lock:
+        entry = _settings_entry
+        if entry is not None and time.monotonic() - entry[1] < SETTINGS_CACHE_TTL:
+            return entry[0]
+        return fetch_settings(stale=entry[0] if entry else None)
 
 def create_user(user_id, username, full_name, invited_by=None):
     try:
@@ -184,6 +329,7 @@ def credit_referrer(inviter_id, referred_id):
             'type_param': 'referral',
             'description_param': f'Referral bonus for user {referred_id}'
         }).execute()
+        invalidate_user(inviter_id)
         
         # Record referral
         supabase.table('referrals').insert({
@@ -195,6 +341,29 @@ def credit_referrer(inviter_id, referred_id):
     except Exception as e:
         logger.error(f"Error crediting referrer: {e}")
 
+async def cached_rpc(cache, key, fn):
+    """Return a cached Web3 read, running the blocking RPC off the event loop on a miss"""
+    value = cache.get(key)
+    if value is None:
+        value = await asyncio.get_running_loop().run_in_executor(None, fn)
+        cache[key] = value
+    return value
+
+async def iter_user_id_pages(page_size=1000):
+    """Yield user ids page by page using keyset pagination on id"""
+    last_id = None
+    while True:
+        query = supabase.table('users').select('id').order('id').limit(page_size)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        page = [row['id'] for row in (await db_execute(query)).data]
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]
+
 async def check_group_membership(context, user_id):
     """Check if user is member of all required groups"""
     try:
@@ -211,6 +380,11 @@ async def check_group_membership(context, user_id):
         logger.error(f"Error in group membership check: {e}")
         return False
 
+@functools.lru_cache(maxsize=4096)
+def short_addr(address, head=6, tail=4):
+    """Shorten a wallet address for display, e.g. 0x742d...e1e1"""
+    return f"{address[:head]}...{address[-tail:]}"
+
 def is_valid_bsc_address(address):
     """Validate BSC wallet address"""
     return re.match(r'^0x[a-fA-F0-9]{40}$', address) is not None
@@ -248,11 +422,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 invited_by = None
         
         # Get or create user
-        db_user = get_user(user_id)
+        db_user = await asyncio.to_thread(get_user, user_id)
         
         if not db_user:
             # New user - start onboarding process
-            db_user = create_user(user_id, user.username, user.full_name, invited_by)
+            db_user = await asyncio.to_thread(create_user, user_id, user.username, user.full_name, invited_by)
             if db_user:
                 welcome_msg = "🎉 Welcome to MetaCore Airdrop!\n\n"
                 welcome_msg += "✅ You received 1000 MetaCore signup bonus!\n\n"
@@ -354,7 +528,8 @@ async def process_telegram_handle(update: Update, context: ContextTypes.DEFAULT_
                 handle = handle[1:]
             
             # Update user's telegram handle
-            supabase.table('users').update({'telegram_handle': handle}).eq('id', user_id).execute()
+            await db_execute(supabase.table('users').update({'telegram_handle': handle}).eq('id', user_id))
+            invalidate_user(user_id)
             
             # Move to Twitter handle
             user_states[user_id] = UserState.SETTING_TWITTER
@@ -386,7 +561,8 @@ async def process_twitter_handle(update: Update, context: ContextTypes.DEFAULT_T
                 handle = handle[1:]
             
             # Update user's twitter handle
-            supabase.table('users').update({'twitter_handle': handle}).eq('id', user_id).execute()
+            await db_execute(supabase.table('users').update({'twitter_handle': handle}).eq('id', user_id))
+            invalidate_user(user_id)
             
             # Move to group joining
             await update.message.reply_text(
@@ -414,20 +590,13 @@ async def handle_join_groups(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     user_states[user_id] = UserState.JOINING_GROUPS
     
-    msg = "📢 Join ALL these groups to participate:\n\n"
-    msg += "1️⃣ [MetaCore Airdrop Chat](https://t.me/MetaAirdropchat)\n"
-    msg += "2️⃣ [MetaCore Airdrop News](https://t.me/metaairdropnews)\n" 
-    msg += "3️⃣ [Bot News](https://t.me/botnewz1)\n\n"
-    msg += "⚠️ You must join ALL groups!\n"
-    msg += "After joining, click the button below:"
-    
-    await update.message.reply_text(msg, reply_markup=GROUPS_KEYBOARD)
+    await update.message.reply_text(JOIN_GROUPS_MSG, reply_markup=GROUPS_KEYBOARD)
 
 async def verify_group_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        user = get_user(user_id)
+        user = await asyncio.to_thread(get_user, user_id)
         if not user:
             await update.message.reply_text("❌ User not found.")
             return
@@ -444,22 +613,23 @@ async def verify_group_membership(update: Update, context: ContextTypes.DEFAULT_
         # For testing, skip actual group check (remove this when groups are ready)
         if True:  # Change to: if await check_group_membership(context, user_id):
             # Update user as verified and mark bonus as received
-            supabase.table('users').update({
+            await db_execute(supabase.table('users').update({
                 'joined_all_groups': True,
                 'has_received_group_bonus': True
-            }).eq('id', user_id).execute()
+            }).eq('id', user_id))
             
             # Get group join bonus
-            settings = get_settings()
+            settings = await asyncio.to_thread(get_settings)
             bonus = settings['group_join_bonus']
             
             # Credit bonus using database function
-            supabase.rpc('add_balance', {
+            await db_execute(supabase.rpc('add_balance', {
                 'user_id_param': user_id,
                 'amount_param': str(bonus),
                 'type_param': 'group_join',
                 'description_param': 'Group join bonus'
-            }).execute()
+            }))
+            invalidate_user(user_id)
             
             msg = "✅ Excellent! You joined all groups.\n\n"
             msg += f"🎁 You earned {bonus} MetaCore bonus!\n\n"
@@ -486,8 +656,8 @@ async def handle_referral_link(update: Update, context: ContextTypes.DEFAULT_TYP
         referral_link = f"https://t.me/{bot_username}?start=ref{user_id}"
         
         # Get referral stats
-        referrals = supabase.table('referrals').select('*').eq('inviter', user_id).execute()
-        referral_count = len(referrals.data) if referrals.data else 0
+        referrals = await db_execute(supabase.table('referrals').select('id', count='exact', head=True).eq('inviter', user_id))
+        referral_count = referrals.count or 0
         
         msg = f"🔗 Your Referral Link:\n"
         msg += f"{referral_link}\n\n"
@@ -506,10 +676,10 @@ async def handle_referral_link(update: Update, context: ContextTypes.DEFAULT_TYP
 async def handle_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        user = get_user(user_id)
+        user = await asyncio.to_thread(get_user, user_id)
         
         if user:
-            balance_tokens = float(user['balance'])
+            balance_tokens = user['balance']
             
             msg = f"💰 Your MetaCore Balance\n\n"
             msg += f"🪙 {balance_tokens:,.0f} MetaCore\n"
@@ -517,7 +687,7 @@ async def handle_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             if user['metacore_address']:
                 address = user['metacore_address']
-                msg += f"📍 Wallet: {address[:6]}...{address[-4:]}"
+                msg += f"📍 Wallet: {short_addr(address)}"
             else:
                 msg += f"⚠️ No wallet set - please set your BSC address!"
         else:
@@ -533,19 +703,7 @@ async def handle_set_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_states[user_id] = UserState.SETTING_WALLET
     
-    msg = "💳 Set Your BSC Wallet Address\n\n"
-    msg += "⚠️ Send your MetaCore (BEP-20) wallet address\n"
-    msg += "⚠️ Must start with 0x and be 42 characters\n"
-    msg += "⚠️ Double-check - wrong address = lost tokens!\n\n"
-    msg += "Example: 0x742d35Cc6634C0532925a3b8D4C0C8b3C2e1e1e1\n\n"
-    msg += "🔗 BSC Testnet Network Details:\n"
-    msg += "• Network Name: BSC Testnet\n"
-    msg += "• RPC URL: https://data-seed-prebsc-1-s1.binance.org:8545/\n"
-    msg += "• Chain ID: 97\n"
-    msg += "• Symbol: tBNB\n"
-    msg += "• Block Explorer: https://testnet.bscscan.com"
-    
-    await update.message.reply_text(msg)
+    await update.message.reply_text(SET_WALLET_MSG)
 
 async def process_wallet_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -553,7 +711,8 @@ async def process_wallet_address(update: Update, context: ContextTypes.DEFAULT_T
         address = update.message.text.strip()
         
         if is_valid_bsc_address(address):
-            supabase.table('users').update({'metacore_address': address}).eq('id', user_id).execute()
+            await db_execute(supabase.table('users').update({'metacore_address': address}).eq('id', user_id))
+            invalidate_user(user_id)
             user_states[user_id] = UserState.MAIN
             
             msg = f"✅ Wallet Address Saved!\n\n"
@@ -577,7 +736,7 @@ async def process_wallet_address(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        user = get_user(user_id)
+        user = await asyncio.to_thread(get_user, user_id)
         
         if not user:
             await update.message.reply_text("❌ User not found. Please /start first.")
@@ -591,9 +750,9 @@ async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Please set your BSC wallet address first!")
             return
         
-        settings = get_settings()
+        settings = await asyncio.to_thread(get_settings)
         min_amount = float(settings['min_withdraw_amount'])
-        balance_tokens = float(user['balance'])
+        balance_tokens = user['balance']
         
         if balance_tokens < min_amount:
             msg = f"❌ Insufficient Balance!\n\n"
@@ -609,7 +768,7 @@ async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = f"💸 Withdrawal Request\n\n"
         msg += f"💰 Available: {balance_tokens:,.0f} MetaCore\n"
         msg += f"📊 Minimum: {min_amount:,.0f} MetaCore\n\n"
-        msg += f"💳 To: {address[:10]}...{address[-6:]}\n\n"
+        msg += f"💳 To: {short_addr(address, 10, 6)}\n\n"
         msg += f"🔗 Network: BSC Testnet\n\n"
         msg += f"Enter withdrawal amount or type 'all':"
         
@@ -623,14 +782,16 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
     try:
         user_id = update.effective_user.id
         text = update.message.text.strip().lower()
-        user = get_user(user_id)
+        user, settings = await asyncio.gather(
+            asyncio.to_thread(get_user, user_id),
+            asyncio.to_thread(get_settings)
+        )
         
         if not user:
             await update.message.reply_text("❌ User not found.")
             return
         
-        balance_tokens = float(user['balance'])
-        settings = get_settings()
+        balance_tokens = user['balance']
         min_amount = float(settings['min_withdraw_amount'])
         
         # Parse amount
@@ -659,24 +820,12 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
             'status': 'pending'
         }
         
-        result = supabase.table('withdrawals').insert(withdrawal_data).execute()
+        result = await db_execute(supabase.table('withdrawals').insert(withdrawal_data))
         if not result.data:
             await update.message.reply_text("❌ Error creating withdrawal request.")
             return
             
         withdrawal_id = result.data[0]['id']
-        
-        # Deduct from balance using database function
-        success = supabase.rpc('subtract_balance', {
-            'user_id_param': user_id,
-            'amount_param': str(amount),
-            'type_param': 'withdrawal',
-            'reference_id_param': withdrawal_id
-        }).execute()
-        
-        # Notify admin
-        await notify_admin_withdrawal(context, withdrawal_id, user, amount)
-        
         user_states[user_id] = UserState.MAIN
         
         address = user['metacore_address']
@@ -688,7 +837,19 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
         msg += f"⏳ Admin will review within 24 hours.\n"
         msg += f"💬 You'll be notified when processed!"
         
-        await update.message.reply_text(msg, reply_markup=MAIN_KEYBOARD)
+        # Deduct first, so a failed deduction never reaches the admin as an approvable request
+        await db_execute(supabase.rpc('subtract_balance', {
+            'user_id_param': user_id,
+            'amount_param': str(amount),
+            'type_param': 'withdrawal',
+            'reference_id_param': withdrawal_id
+        }))
+        invalidate_user(user_id)
+        
+        await asyncio.gather(
+            notify_admin_withdrawal(context, withdrawal_id, user, amount),
+            update.message.reply_text(msg, reply_markup=MAIN_KEYBOARD)
+        )
         
     except Exception as e:
         logger.error(f"Error processing withdrawal: {e}")
@@ -725,26 +886,31 @@ async def notify_admin_withdrawal(context, withdrawal_id, user, amount):
 async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        user = get_user(user_id)
+        # Both lookups only need user_id, so run them concurrently
+        user, referrals = await asyncio.gather(
+            asyncio.to_thread(get_user, user_id),
+            db_execute(supabase.table('referrals').select('id', count='exact', head=True).eq('inviter', user_id))
+        )
         
         if user:
-            balance_tokens = float(user['balance'])
-            referrals = supabase.table('referrals').select('*').eq('inviter', user_id).execute()
-            referral_count = len(referrals.data) if referrals.data else 0
+            balance_tokens = user['balance']
+            referral_count = referrals.count or 0
             
             username = user['username'] or 'N/A'
             
-            msg = f"👤 Your Profile\n\n"
-            msg += f"🆔 ID: {user['id']}\n"
-            msg += f"👤 Username: @{username}\n"
-            msg += f"📱 Telegram: @{user.get('telegram_handle', 'Not set')}\n"
-            msg += f"🐦 Twitter: @{user.get('twitter_handle', 'Not set')}\n"
-            msg += f"💰 Balance: {balance_tokens:,.0f} MetaCore\n"
-            msg += f"👥 Referrals: {referral_count}\n"
-            msg += f"💳 Wallet: {'Set' if user['metacore_address'] else 'Not Set'}\n"
-            msg += f"✅ Groups: {'Joined' if user['joined_all_groups'] else 'Not Joined'}\n"
-            msg += f"🔗 Network: BSC Testnet\n"
-            msg += f"📅 Joined: {user['created_at'][:10]}"
+            msg = (
+                f"👤 Your Profile\n\n"
+                f"🆔 ID: {user['id']}\n"
+                f"👤 Username: @{username}\n"
+                f"📱 Telegram: @{user.get('telegram_handle', 'Not set')}\n"
+                f"🐦 Twitter: @{user.get('twitter_handle', 'Not set')}\n"
+                f"💰 Balance: {balance_tokens:,.0f} MetaCore\n"
+                f"👥 Referrals: {referral_count}\n"
+                f"💳 Wallet: {'Set' if user['metacore_address'] else 'Not Set'}\n"
+                f"✅ Groups: {'Joined' if user['joined_all_groups'] else 'Not Joined'}\n"
+                f"🔗 Network: BSC Testnet\n"
+                f"📅 Joined: {user['created_at'][:10]}"
+            )
         else:
             msg = "❌ User not found. Please /start first."
         
@@ -755,22 +921,7 @@ async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Error getting profile.")
 
 async def handle_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = "❓ MetaCore Airdrop Help\n\n"
-    msg += "🎯 How to earn:\n"
-    msg += "• Join groups: +500 MetaCore\n"
-    msg += "• Refer friends: +4000 MetaCore each\n\n"
-    msg += "💸 Withdrawal:\n"
-    msg += "• Minimum: 4000 MetaCore\n"
-    msg += "• Set BSC wallet first\n"
-    msg += "• Admin approval required\n"
-    msg += "• Network: BSC Testnet\n\n"
-    msg += "🔗 BSC Testnet Setup:\n"
-    msg += "• RPC: https://data-seed-prebsc-1-s1.binance.org:8545/\n"
-    msg += "• Chain ID: 97\n"
-    msg += "• Symbol: tBNB\n\n"
-    msg += "🔗 Support: @your_support_username"
-    
-    await update.message.reply_text(msg)
+    await update.message.reply_text(HELP_MSG)
 
 # Admin callback handlers
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -793,16 +944,16 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def approve_withdrawal(query, context, withdrawal_id):
     try:
         # Set to processing
-        supabase.table('withdrawals').update({
+        await db_execute(supabase.table('withdrawals').update({
             'status': 'processing',
             'processed_at': 'now()'
-        }).eq('id', withdrawal_id).execute()
+        }).eq('id', withdrawal_id))
         
         # Get withdrawal details
-        withdrawal = supabase.table('withdrawals').select('*').eq('id', withdrawal_id).execute().data[0]
+        withdrawal = (await db_execute(supabase.table('withdrawals').select('*').eq('id', withdrawal_id))).data[0]
         
         # Process payment immediately
-        success = await process_payment(withdrawal)
+        success = await asyncio.to_thread(process_payment, withdrawal)
         
         if success:
             await query.edit_message_text(
@@ -816,12 +967,13 @@ async def approve_withdrawal(query, context, withdrawal_id):
             )
         else:
             # Refund user balance on failure
-            supabase.rpc('add_balance', {
+            await db_execute(supabase.rpc('add_balance', {
                 'user_id_param': withdrawal['user_id'],
                 'amount_param': withdrawal['amount'],
                 'type_param': 'refund',
                 'description_param': f'Refund for failed withdrawal #{withdrawal_id}'
-            }).execute()
+            }))
+            invalidate_user(withdrawal['user_id'])
             
             await query.edit_message_text(
                 f"❌ Failed to process withdrawal {withdrawal_id}. Balance refunded."
@@ -831,18 +983,19 @@ async def approve_withdrawal(query, context, withdrawal_id):
         logger.error(f"Error approving withdrawal: {e}")
         
         # Refund on exception
-        withdrawal = supabase.table('withdrawals').select('*').eq('id', withdrawal_id).execute().data[0]
-        supabase.rpc('add_balance', {
+        withdrawal = (await db_execute(supabase.table('withdrawals').select('*').eq('id', withdrawal_id))).data[0]
+        await db_execute(supabase.rpc('add_balance', {
             'user_id_param': withdrawal['user_id'],
             'amount_param': withdrawal['amount'],
             'type_param': 'refund',
             'description_param': f'Refund for failed withdrawal #{withdrawal_id}'
-        }).execute()
+        }))
+        invalidate_user(withdrawal['user_id'])
         
-        supabase.table('withdrawals').update({
+        await db_execute(supabase.table('withdrawals').update({
             'status': 'failed',
             'admin_note': f'Error: {str(e)[:100]}'
-        }).eq('id', withdrawal_id).execute()
+        }).eq('id', withdrawal_id))
         
         await query.edit_message_text(
             f"❌ Error processing withdrawal {withdrawal_id}. Balance refunded."
@@ -852,22 +1005,23 @@ async def reject_withdrawal(query, context, withdrawal_id):
     """Reject withdrawal and refund balance"""
     try:
         # Get withdrawal details
-        withdrawal = supabase.table('withdrawals').select('*').eq('id', withdrawal_id).execute().data[0]
+        withdrawal = (await db_execute(supabase.table('withdrawals').select('*').eq('id', withdrawal_id))).data[0]
         
         # Update withdrawal status
-        supabase.table('withdrawals').update({
+        await db_execute(supabase.table('withdrawals').update({
             'status': 'rejected',
             'processed_at': 'now()',
             'admin_note': 'Rejected by admin'
-        }).eq('id', withdrawal_id).execute()
+        }).eq('id', withdrawal_id))
         
         # Refund user balance using database function
-        supabase.rpc('add_balance', {
+        await db_execute(supabase.rpc('add_balance', {
             'user_id_param': withdrawal['user_id'],
             'amount_param': withdrawal['amount'],
             'type_param': 'refund',
             'description_param': f'Refund for rejected withdrawal #{withdrawal_id}'
-        }).execute()
+        }))
+        invalidate_user(withdrawal['user_id'])
         
         await query.edit_message_text(
             f"❌ Withdrawal {withdrawal_id} rejected and refunded!"
@@ -885,7 +1039,7 @@ async def reject_withdrawal(query, context, withdrawal_id):
             f"❌ Error rejecting withdrawal {withdrawal_id}"
         )
 
-async def process_payment(withdrawal):
+def process_payment(withdrawal):
     """Process actual token transfer on BSC Testnet"""
     try:
         if not CONTRACT_ADDRESS or not ADMIN_PRIVATE_KEY:
@@ -965,22 +1119,16 @@ async def process_payment(withdrawal):
         return True
 
 # Admin commands
+@admin_only
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    
     try:
-        # Get stats
-        users = supabase.table('users').select('*').execute()
-        withdrawals = supabase.table('withdrawals').select('*').execute()
-        referrals = supabase.table('referrals').select('*').execute()
+        # Get stats aggregated server-side (see get_bot_stats migration)
+        stats = (await db_execute(supabase.rpc('get_bot_stats'))).data
         
-        total_users = len(users.data)
-        total_referrals = len(referrals.data)
-        pending_withdrawals = len([w for w in withdrawals.data if w['status'] == 'pending'])
-        
-        # Calculate total balance
-        total_balance = sum(float(user['balance']) for user in users.data)
+        total_users = stats['total_users']
+        total_referrals = stats['total_referrals']
+        pending_withdrawals = stats['pending_withdrawals']
+        total_balance = float(stats['total_balance'])
         
         msg = f"📊 Admin Statistics\n\n"
         msg += f"👥 Total Users: {total_users:,}\n"
@@ -996,43 +1144,54 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in admin stats: {e}")
         await update.message.reply_text("❌ Error getting statistics.")
 
+@admin_only
 async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Broadcast message to all users"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-        
     if len(context.args) < 1:
         await update.message.reply_text("Usage: /broadcast <message>")
         return
     
     try:
         message = ' '.join(context.args)
-        users = supabase.table('users').select('id').execute()
+        total_users = (await db_execute(supabase.table('users').select('id', count='exact', head=True))).count or 0
         
         sent = 0
         failed = 0
         
         status_msg = await update.message.reply_text(
-            f"📡 Broadcasting to {len(users.data)} users..."
+            f"📡 Broadcasting to {total_users} users..."
         )
         
-        for user in users.data:
-            try:
-                await context.bot.send_message(
-                    chat_id=user['id'], 
-                    text=f"📢 Admin Broadcast\n\n{message}"
-                )
-                sent += 1
-                
-                # Update status every 50 users
-                if sent % 50 == 0:
-                    await status_msg.edit_text(
-                        f"📡 Sent to {sent}/{len(users.data)} users..."
-                    )
-                    
-            except Exception as e:
-                failed += 1
-                logger.error(f"Failed to send to {user['id']}: {e}")
+        text = f"📢 Admin Broadcast\n\n{message}"
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        pacer = SendPacer(BROADCAST_RATE)
+        
+        async def send_one(user_id):
+            async with semaphore:
+                for attempt in range(BROADCAST_MAX_ATTEMPTS):
+                    await pacer.acquire()
+                    try:
+                        await context.bot.send_message(chat_id=user_id, text=text)
+                        return True
+                    except RetryAfter as e:
+                        # Flood control applies to the whole bot, so every sender waits it out
+                        logger.warning(f"Flood limit hit sending to {user_id}, retrying in {e.retry_after}s")
+                        pacer.pause(e.retry_after)
+                    except Exception as e:
+                        logger.error(f"Failed to send to {user_id}: {e}")
+                        return False
+                logger.error(f"Failed to send to {user_id}: still rate limited after {BROADCAST_MAX_ATTEMPTS} attempts")
+                return False
+        
+        async for page in iter_user_id_pages(page_size=BROADCAST_BATCH_SIZE):
+            results = await asyncio.gather(*(send_one(user_id) for user_id in page))
+            batch_sent = sum(results)
+            sent += batch_sent
+            failed += len(results) - batch_sent
+            
+            await status_msg.edit_text(
+                f"📡 Sent to {sent}/{total_users} users..."
+            )
         
         await status_msg.edit_text(
             f"✅ Broadcast complete!\n📤 Sent: {sent}\n❌ Failed: {failed}"
@@ -1042,23 +1201,21 @@ async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in broadcast: {e}")
         await update.message.reply_text("❌ Error broadcasting message.")
 
+@admin_only
 async def handle_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get user information"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-        
     if len(context.args) < 1:
         await update.message.reply_text("Usage: /userinfo <user_id>")
         return
     
     try:
         user_id = int(context.args[0])
-        user = get_user(user_id)
+        # User row and both counts in one round trip (see admin_user_summary migration)
+        summary = (await db_execute(supabase.rpc('admin_user_summary', {'user_id_param': user_id}))).data
         
-        if user:
-            balance = float(user['balance'])
-            referrals = supabase.table('referrals').select('*').eq('inviter', user_id).execute()
-            withdrawals = supabase.table('withdrawals').select('*').eq('user_id', user_id).execute()
+        if summary:
+            user = summary['user']
+            balance = float(user['balance'] or 0)
             
             username = user['username'] or 'N/A'
             full_name = user['full_name'] or 'N/A'
@@ -1066,19 +1223,21 @@ async def handle_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             telegram_handle = user.get('telegram_handle', 'Not set')
             twitter_handle = user.get('twitter_handle', 'Not set')
             
-            msg = f"👤 User Info: {user_id}\n\n"
-            msg += f"Username: @{username}\n"
-            msg += f"Full Name: {full_name}\n"
-            msg += f"Telegram: @{telegram_handle}\n"
-            msg += f"Twitter: @{twitter_handle}\n"
-            msg += f"Balance: {balance:,.0f} MetaCore\n"
-            msg += f"Referrals: {len(referrals.data)}\n"
-            msg += f"Withdrawals: {len(withdrawals.data)}\n"
-            msg += f"Groups Joined: {'Yes' if user['joined_all_groups'] else 'No'}\n"
-            msg += f"Group Bonus: {'Yes' if user.get('has_received_group_bonus', False) else 'No'}\n"
-            msg += f"Wallet: {wallet}\n"
-            msg += f"Invited By: {user['invited_by'] or 'Direct'}\n"
-            msg += f"Joined: {user['created_at'][:10]}"
+            msg = (
+                f"👤 User Info: {user_id}\n\n"
+                f"Username: @{username}\n"
+                f"Full Name: {full_name}\n"
+                f"Telegram: @{telegram_handle}\n"
+                f"Twitter: @{twitter_handle}\n"
+                f"Balance: {balance:,.0f} MetaCore\n"
+                f"Referrals: {summary['referral_count']}\n"
+                f"Withdrawals: {summary['withdrawal_count']}\n"
+                f"Groups Joined: {'Yes' if user['joined_all_groups'] else 'No'}\n"
+                f"Group Bonus: {'Yes' if user.get('has_received_group_bonus', False) else 'No'}\n"
+                f"Wallet: {wallet}\n"
+                f"Invited By: {user['invited_by'] or 'Direct'}\n"
+                f"Joined: {user['created_at'][:10]}"
+            )
             
             await update.message.reply_text(msg)
         else:
@@ -1090,11 +1249,9 @@ async def handle_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in user info: {e}")
         await update.message.reply_text("❌ Error getting user info.")
 
+@admin_only
 async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add balance to user"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-        
     if len(context.args) < 2:
         await update.message.reply_text("Usage: /addbalance <user_id> <amount>")
         return
@@ -1103,21 +1260,22 @@ async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE)
         user_id = int(context.args[0])
         amount = float(context.args[1])
         
-        user = get_user(user_id)
+        user = await asyncio.to_thread(get_user, user_id)
         if not user:
             await update.message.reply_text("❌ User not found")
             return
         
         # Add balance using database function
-        supabase.rpc('add_balance', {
+        await db_execute(supabase.rpc('add_balance', {
             'user_id_param': user_id,
             'amount_param': str(amount),
             'type_param': 'admin_credit',
             'description_param': f'Admin credit by {update.effective_user.id}'
-        }).execute()
+        }))
+        invalidate_user(user_id)
         
         # Log admin action
-        supabase.table('admin_logs').insert({
+        await db_execute(supabase.table('admin_logs').insert({
             'admin_id': update.effective_user.id,
             'action': 'add_balance',
             'details': {
@@ -1125,7 +1283,7 @@ async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 'amount': amount,
                 'username': user['username']
             }
-        }).execute()
+        }))
         
         username = user['username'] or 'N/A'
         msg = f"✅ Added {amount:,.0f} MetaCore to @{username} ({user_id})"
@@ -1146,22 +1304,21 @@ async def handle_add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Error adding balance: {e}")
         await update.message.reply_text("❌ Error adding balance.")
 
+@admin_only
 async def handle_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show pending withdrawals"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-    
     try:
-        withdrawals = supabase.table('withdrawals').select('*').eq('status', 'pending').order('created_at').execute()
+        withdrawals = await db_execute(supabase.table('withdrawals').select('*').eq('status', 'pending').order('created_at'))
         
         if not withdrawals.data:
             await update.message.reply_text("✅ No pending withdrawals")
             return
         
-        msg = f"⏳ Pending Withdrawals ({len(withdrawals.data)})\n\n"
+        total_pending = len(withdrawals.data)
+        msg = f"⏳ Pending Withdrawals ({total_pending})\n\n"
         
         for w in withdrawals.data[:10]:  # Show first 10
-            user = get_user(w['user_id'])
+            user = await asyncio.to_thread(get_user, w['user_id'])
             username = user['username'] if user else 'Unknown'
             amount = float(w['amount'])
             address = w['to_address']
@@ -1169,11 +1326,11 @@ async def handle_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE)
             msg += f"🆔 #{w['id']}\n"
             msg += f"👤 @{username} ({w['user_id']})\n"
             msg += f"💰 {amount:,.0f} MetaCore\n"
-            msg += f"📍 {address[:10]}...{address[-6:]}\n"
+            msg += f"📍 {short_addr(address, 10, 6)}\n"
             msg += f"⏰ {w['created_at'][:16]}\n\n"
         
-        if len(withdrawals.data) > 10:
-            msg += f"... and {len(withdrawals.data) - 10} more"
+        if total_pending > 10:
+            msg += f"... and {total_pending - 10} more"
         
         await update.message.reply_text(msg)
         
@@ -1181,22 +1338,22 @@ async def handle_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Error getting withdrawals: {e}")
         await update.message.reply_text("❌ Error getting withdrawals.")
 
+@admin_only
 async def handle_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show/update bot settings"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-    
     try:
-        settings = get_settings()
-        
-        msg = f"⚙️ Bot Settings\n\n"
-        msg += f"💰 Signup Bonus: {settings['signup_bonus']} MetaCore\n"
-        msg += f"🎁 Referral Bonus: {settings['referral_bonus']} MetaCore\n"
-        msg += f"👥 Group Join Bonus: {settings['group_join_bonus']} MetaCore\n"
-        msg += f"📊 Min Withdrawal: {settings['min_withdraw_amount']} MetaCore\n"
-        msg += f"💵 Token Price: ${settings.get('token_price_usd', 0.0225)}\n"
-        msg += f"🔗 Network: BSC Testnet\n\n"
-        msg += f"Use /setsetting <key> <value> to update"
+        settings = await asyncio.to_thread(get_settings)
+        
+        msg = "\n".join([
+            "⚙️ Bot Settings\n",
+            f"💰 Signup Bonus: {settings['signup_bonus']} MetaCore",
+            f"🎁 Referral Bonus: {settings['referral_bonus']} MetaCore",
+            f"👥 Group Join Bonus: {settings['group_join_bonus']} MetaCore",
+            f"📊 Min Withdrawal: {settings['min_withdraw_amount']} MetaCore",
+            f"💵 Token Price: ${settings.get('token_price_usd', 0.0225)}",
+            "🔗 Network: BSC Testnet\n",
+            "Use /setsetting <key> <value> to update"
+        ])
         
         await update.message.reply_text(msg)
         
@@ -1204,11 +1361,9 @@ async def handle_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error getting settings: {e}")
         await update.message.reply_text("❌ Error getting settings.")
 
+@admin_only
 async def handle_set_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Update a setting"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-        
     if len(context.args) < 2:
         await update.message.reply_text("Usage: /setsetting <key> <value>\nKeys: signup_bonus, referral_bonus, group_join_bonus, min_withdraw_amount, token_price_usd")
         return
@@ -1224,17 +1379,18 @@ async def handle_set_setting(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
         
         # Update setting
-        supabase.table('settings').update({key: value}).eq('id', 1).execute()
+        await db_execute(supabase.table('settings').update({key: value}).eq('id', 1))
+        invalidate_settings()
         
         # Log admin action
-        supabase.table('admin_logs').insert({
+        await db_execute(supabase.table('admin_logs').insert({
             'admin_id': update.effective_user.id,
             'action': 'update_setting',
             'details': {
                 'key': key,
                 'value': value
             }
-        }).execute()
+        }))
         
         await update.message.reply_text(f"✅ Updated {key} to {value}")
         
@@ -1242,15 +1398,13 @@ async def handle_set_setting(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Error updating setting: {e}")
         await update.message.reply_text("❌ Error updating setting.")
 
+@admin_only
 async def handle_network_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show BSC Testnet network information"""
-    if update.effective_user.id != ADMIN_ID:
-        return
-    
     try:
         # Check Web3 connection
-        is_connected = w3.isConnected()
-        latest_block = w3.eth.block_number if is_connected else "N/A"
+        is_connected = await cached_rpc(_chain_cache, 'connected', w3.is_connected)
+        latest_block = await cached_rpc(_chain_cache, 'block', lambda: w3.eth.block_number) if is_connected else "N/A"
         
         msg = f"🔗 BSC Testnet Network Info\n\n"
         msg += f"📡 Connection: {'✅ Connected' if is_connected else '❌ Disconnected'}\n"
@@ -1268,7 +1422,10 @@ async def handle_network_info(update: Update, context: ContextTypes.DEFAULT_TYPE
         if ADMIN_PRIVATE_KEY:
             admin_account = w3.eth.account.from_key(ADMIN_PRIVATE_KEY)
             if is_connected:
-                balance = w3.eth.get_balance(admin_account.address)
+                balance = await cached_rpc(
+                    _admin_bnb_cache, admin_account.address,
+                    lambda: w3.eth.get_balance(admin_account.address)
+                )
                 balance_bnb = w3.from_wei(balance, 'ether')
     
                 msg += f"💳 Admin Balance: {balance_bnb:.4f} tBNB"
@@ -1291,7 +1448,9 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 def main():
     """Start the bot"""
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Handlers hand their blocking I/O to worker threads, so updates
+        # from different users can safely be processed concurrently
+        application = Application.builder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES).build()
         
         # Add handlers
         application.add_handler(CommandHandler("start", start))
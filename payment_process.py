@@ -1,105 +1,88 @@
 import os
+import asyncio
+import atexit
+import requests
 from web3 import Web3
+from web3.exceptions import TransactionNotFound
 from supabase import create_client
-import json
 import time
+import random
 import logging
+import logging.handlers
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from decimal import Decimal
-from datetime import datetime, timedelta
+from chain_config import (
+    SUPABASE_URL, SUPABASE_KEY, BSC_NODE_URL, CONTRACT_ADDRESS, ADMIN_PRIVATE_KEY,
+    IS_TESTNET, CHAIN_ID, NETWORK_NAME, ERC20_ABI, make_http_session,
+    rpc_batch, encode_transfer
+)
 
-# Setup logging
+# Setup logging - records go through a queue so file/console I/O happens on a background thread
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_file_handler = logging.handlers.RotatingFileHandler('payment_processor.log', maxBytes=10 * 1024 * 1024, backupCount=5, delay=True)
+_stream_handler = logging.StreamHandler()
+for _handler in (_file_handler, _stream_handler):
+    _handler.setFormatter(_log_formatter)
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # flush queued records on exit, including startup failures
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('payment_processor.log'),
-        logging.StreamHandler()
-    ]
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format='%(message)s',  # the listener's handlers apply the real format
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
-# Configuration - FIXED: Use testnet by default
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-# FIXED: Default to testnet instead of mainnet
-BSC_NODE_URL = os.getenv("BSC_NODE_URL", "https://data-seed-prebsc-1-s1.binance.org:8545/")
-CONTRACT_ADDRESS = os.getenv("CONTRACT_ADDRESS")
-ADMIN_PRIVATE_KEY = os.getenv("ADMIN_PRIVATE_KEY")
-ADMIN_ADDRESS = os.getenv("ADMIN_ADDRESS")
-
-# FIXED: Determine network based on URL
-IS_TESTNET = "testnet" in BSC_NODE_URL or "prebsc" in BSC_NODE_URL
-CHAIN_ID = 97 if IS_TESTNET else 56
-NETWORK_NAME = "BSC Testnet" if IS_TESTNET else "BSC Mainnet"
+# Standard ERC-20 transfers cost ~52k gas; this leaves a safety margin
+TRANSFER_GAS_LIMIT = int(os.getenv("TRANSFER_GAS_LIMIT", "80000"))
 
 logger.info(f"Network: {NETWORK_NAME} (Chain ID: {CHAIN_ID})")
 
-# Validate required environment variables
-required_vars = [SUPABASE_URL, SUPABASE_KEY, CONTRACT_ADDRESS, ADMIN_PRIVATE_KEY]
-missing_vars = [var for var in required_vars if not var]
+# Keep-alive session so RPC calls reuse TCP+TLS connections
+http_session = make_http_session(pool_connections=16, pool_maxsize=64, backoff_factor=0.2)
+w3 = Web3(Web3.HTTPProvider(BSC_NODE_URL, session=http_session, request_kwargs={'timeout': 15}))
 
-if missing_vars:
-    logger.error(f"Missing required environment variables: {missing_vars}")
-    exit(1)
+# Set by init(); nothing touches the network at import time
+supabase = None
+TOKEN_DECIMALS = TOKEN_UNIT = TOKEN_SYMBOL = TOKEN_NAME = None
+ADMIN_ACCOUNT = ADMIN_ADDR = CONTRACT_ADDR = None
 
-# Initialize
-try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    w3 = Web3(Web3.HTTPProvider(BSC_NODE_URL))
-    
-    # FIXED: Use is_connected() instead of is_connected
-    if not w3.is_connected():
-        logger.error("Failed to connect to BSC node")
-        exit(1)
-    
-    logger.info(f"Connected to {NETWORK_NAME}. Latest block: {w3.eth.block_number}")
-    
-except Exception as e:
-    logger.error(f"Initialization failed: {e}")
-    exit(1)
-
-# Extended ERC-20 ABI
-ERC20_ABI = json.loads('''[
+# Multicall3 is deployed at the same address on BSC mainnet and testnet
+MULTICALL3_ADDRESS = Web3.to_checksum_address('0xcA11bde05977b3631167028862bE2a173976CA11')
+MULTICALL3_ABI = [
     {
-        "constant": false,
         "inputs": [
-            {"name": "_to", "type": "address"},
-            {"name": "_value", "type": "uint256"}
+            {"name": "requireSuccess", "type": "bool"},
+            {
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "callData", "type": "bytes"}
+                ],
+                "name": "calls",
+                "type": "tuple[]"
+            }
         ],
-        "name": "transfer",
-        "outputs": [{"name": "", "type": "bool"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [{"name": "_owner", "type": "address"}],
-        "name": "balanceOf",
-        "outputs": [{"name": "balance", "type": "uint256"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [],
-        "name": "decimals",
-        "outputs": [{"name": "", "type": "uint8"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [],
-        "name": "symbol",
-        "outputs": [{"name": "", "type": "string"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [],
-        "name": "name",
-        "outputs": [{"name": "", "type": "string"}],
+        "name": "tryAggregate",
+        "outputs": [
+            {
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ],
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
         "type": "function"
     }
-]''')
+]
 
+@lru_cache(maxsize=None)
 def get_contract():
     """Get contract instance"""
     try:
@@ -112,6 +95,7 @@ def get_contract():
         logger.error(f"Error getting contract: {e}")
         return None
 
+@lru_cache(maxsize=None)
 def get_admin_account():
     """Get admin account from private key"""
     try:
@@ -120,20 +104,145 @@ def get_admin_account():
         logger.error(f"Error getting admin account: {e}")
         return None
 
+@lru_cache(maxsize=None)
+def get_multicall():
+    """Get Multicall3 contract instance"""
+    return w3.eth.contract(address=MULTICALL3_ADDRESS, abi=MULTICALL3_ABI)
+
+def multicall(contract, calls):
+    """Read several (fn_name, args, output_type) view calls in one eth_call, falling back per call"""
+    try:
+        results = get_multicall().functions.tryAggregate(False, [
+            (contract.address, contract.encodeABI(fn_name=fn_name, args=args))
+            for fn_name, args, _ in calls
+        ]).call()
+    except Exception as e:
+        logger.warning(f"Multicall failed, falling back to individual calls: {e}")
+        results = [(False, b'')] * len(calls)
+    
+    values = []
+    for (fn_name, args, output_type), (success, data) in zip(calls, results):
+        if success and data:
+            values.append(w3.codec.decode([output_type], data)[0])
+        else:
+            values.append(getattr(contract.functions, fn_name)(*args).call())
+    return values
+
+# Local nonce counter so several transfers can be in flight at once
+SUBMIT_WORKERS = 8
+# BSC produces a block every ~3s; polling receipts faster than that is wasted RPC traffic
+RECEIPT_POLL_INTERVAL = 3.0 if IS_TESTNET else 2.0
+# Node errors that mean the local counter drifted from the chain
+NONCE_ERRORS = ('nonce too low', 'nonce too high', 'replacement transaction underpriced')
+_nonce_lock = threading.Lock()
+_next_nonce = None
+# Fix-ups noted by workers and applied by settle_nonces() once no send is in flight:
+# nonces known to be unsent, and signed transfers whose broadcast timed out
+_lost_nonces = []
+_maybe_sent = []
+_nonce_drifted = False
+
+def _assign_nonce():
+    """Hand out the next nonce for the admin account"""
+    global _next_nonce
+    with _nonce_lock:
+        nonce = _next_nonce
+        _next_nonce += 1
+        return nonce
+
+def _resync_nonce():
+    """Reload the nonce counter from the chain"""
+    global _next_nonce
+    with _nonce_lock:
+        _next_nonce = w3.eth.get_transaction_count(ADMIN_ADDR, 'pending')
+        logger.warning(f"Nonce resynced from chain: {_next_nonce}")
+
+def _is_nonce_error(error):
+    """Whether a node error means the local nonce counter drifted from the chain"""
+    message = str(error).lower()
+    return any(nonce_error in message for nonce_error in NONCE_ERRORS)
+
+def _note_unsent_nonce(nonce, error):
+    """Record a nonce whose transfer wasn't accepted, for settle_nonces() to fix up"""
+    global _nonce_drifted
+    with _nonce_lock:
+        if _is_nonce_error(error):
+            _nonce_drifted = True
+        else:
+            _lost_nonces.append(nonce)
+
+def _note_maybe_sent(signed_txn):
+    """Record a transfer whose broadcast timed out, for settle_nonces() to resend"""
+    with _nonce_lock:
+        _maybe_sent.append(signed_txn)
+
+def rebroadcast(signed_txn):
+    """Resend a transfer whose broadcast timed out; the identical signed transaction can only land once"""
+    try:
+        broadcast_transaction(signed_txn)
+        return True
+    except Exception as e:
+        if _is_nonce_error(e):
+            # Already pooled or mined
+            return True
+        logger.error(f"❌ Could not rebroadcast {signed_txn.hash.hex()}: {e}")
+        return False
+
+def cancel_nonce(nonce):
+    """Fill the gap left by an unsent nonce with a zero-value self-transfer so later transfers aren't left queued"""
+    transaction = {
+        'chainId': CHAIN_ID,
+        'to': ADMIN_ADDR,
+        'value': 0,
+        'gas': 21000,
+        **get_fee_fields(),
+        'nonce': nonce,
+    }
+    try:
+        tx_hash = broadcast_transaction(ADMIN_ACCOUNT.sign_transaction(transaction))
+        logger.warning(f"Filled nonce gap {nonce} with cancel transaction {tx_hash.hex()}")
+        return True
+    except Exception as e:
+        if _is_nonce_error(e):
+            # Something else already used the nonce, so there is no gap
+            logger.info(f"Nonce {nonce} already used, no cancel needed")
+            return True
+        logger.error(f"❌ Could not fill nonce gap {nonce}: {e}")
+        return False
+
+def settle_nonces():
+    """Fill nonce gaps and resync the counter if needed; only call when no send is in flight"""
+    global _nonce_drifted
+    with _nonce_lock:
+        lost = sorted(_lost_nonces)
+        maybe_sent = list(_maybe_sent)
+        _lost_nonces.clear()
+        _maybe_sent.clear()
+        drifted, _nonce_drifted = _nonce_drifted, False
+    
+    # Timed-out transfers are resent as-is rather than cancelled, since a cancel at
+    # today's fees could replace a payout the node already holds
+    settled = [rebroadcast(signed_txn) for signed_txn in maybe_sent]
+    settled += [cancel_nonce(nonce) for nonce in lost]
+    
+    # A gap that couldn't be filled is resynced so the next sends reuse it
+    if drifted or not all(settled):
+        _resync_nonce()
+
+def get_admin_balance_wei():
+    """Get admin wallet token balance in the token's smallest unit"""
+    return get_contract().functions.balanceOf(ADMIN_ADDR).call()
+
 def check_contract_balance():
     """Check admin wallet token balance"""
     try:
-        contract = get_contract()
-        admin_account = get_admin_account()
-        
-        if not contract or not admin_account:
+        if not get_contract():
             return 0
         
-        balance = contract.functions.balanceOf(admin_account.address).call()
-        decimals = contract.functions.decimals().call()
+        balance = get_admin_balance_wei()
         
         # Convert from wei to tokens
-        token_balance = balance / (10 ** decimals)
+        token_balance = balance / TOKEN_UNIT
         
         logger.info(f"Admin wallet balance: {token_balance:,.2f} tokens")
         return token_balance
@@ -142,10 +251,46 @@ def check_contract_balance():
         logger.error(f"Error checking balance: {e}")
         return 0
 
+# Gas price moves on block scale, so concurrent transfers share one lookup
+GAS_PRICE_TTL = 10
+_gas_price_cache = {'t': 0, 'v': 0, 'base_fee': None, 'tip': 0}
+FEE_HISTORY_BLOCKS = 5
+_gas_price_lock = threading.Lock()
+
+def _parse_fee_history(history, to_int):
+    """Next-block base fee and median recent priority tip from an eth_feeHistory result"""
+    base_fees = history.get('baseFeePerGas') or []
+    base_fee = to_int(base_fees[-1]) if base_fees else None
+    rewards = sorted(to_int(block[0]) for block in history.get('reward') or [] if block)
+    tip = rewards[len(rewards) // 2] if rewards else 0
+    return base_fee, tip
+
+def _refresh_gas_cache():
+    """Fetch the gas price and fee history together (caller holds the lock)"""
+    try:
+        gas_price_hex, history = rpc_batch(http_session, BSC_NODE_URL, [
+            ('eth_gasPrice', []),
+            ('eth_feeHistory', [hex(FEE_HISTORY_BLOCKS), 'latest', [50]]),
+        ])
+        gas_price = int(gas_price_hex, 16)
+        base_fee, tip = _parse_fee_history(history, lambda value: int(value, 16))
+    except Exception as e:
+        logger.warning(f"Batch fee lookup failed, falling back to individual calls: {e}")
+        gas_price = w3.eth.gas_price
+        try:
+            base_fee, tip = _parse_fee_history(w3.eth.fee_history(FEE_HISTORY_BLOCKS, 'latest', [50]), int)
+        except Exception as history_error:
+            logger.warning(f"Fee history unavailable, using legacy gas price: {history_error}")
+            base_fee, tip = None, 0
+    _gas_price_cache.update({'t': time.monotonic(), 'v': gas_price, 'base_fee': base_fee, 'tip': tip})
+
 def get_gas_price():
     """Get current gas price with safety margin"""
     try:
-        gas_price = w3.eth.gas_price
+        with _gas_price_lock:
+            if time.monotonic() - _gas_price_cache['t'] >= GAS_PRICE_TTL:
+                _refresh_gas_cache()
+            gas_price = _gas_price_cache['v']
         # FIXED: Different gas prices for testnet vs mainnet
         if IS_TESTNET:
             # Testnet: use higher gas price for faster confirmation
@@ -159,269 +304,367 @@ def get_gas_price():
         fallback_price = w3.to_wei('10', 'gwei') if IS_TESTNET else w3.to_wei('5', 'gwei')
         return fallback_price
 
-def estimate_gas(contract, admin_address, to_address, amount):
-    """Estimate gas for transaction"""
-    try:
-        gas_estimate = contract.functions.transfer(
-            to_address, amount
-        ).estimate_gas({'from': admin_address})
-        
-        # Add 30% margin for testnet, 20% for mainnet
-        margin = 1.3 if IS_TESTNET else 1.2
-        return int(gas_estimate * margin)
-    except Exception as e:
-        logger.error(f"Error estimating gas: {e}")
-        # Higher fallback for testnet
-        return 300000 if IS_TESTNET else 200000
+def get_fee_fields():
+    """Fee fields for a transfer: EIP-1559 when the chain reports a base fee, legacy gasPrice otherwise"""
+    gas_price = get_gas_price()
+    base_fee = _gas_price_cache['base_fee']
+    if base_fee is None:
+        return {'gasPrice': gas_price}
+    # Never bid below the margin-adjusted legacy price; BSC validators enforce a floor on it
+    tip = max(gas_price, _gas_price_cache['tip'])
+    return {'maxFeePerGas': base_fee * 2 + tip, 'maxPriorityFeePerGas': tip}
+
+def retry_with_backoff(fn, attempts=3, retry_on=(Exception,), base_delay=0.5, max_delay=30):
+    """Call fn, retrying failures with jittered exponential backoff"""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except retry_on as e:
+            if attempt == attempts - 1:
+                raise
+            delay = min(base_delay * 2 ** attempt, max_delay) + random.random() * 0.3
+            logger.warning(f"Attempt {attempt + 1}/{attempts} failed: {e}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
 
-def wait_for_transaction_receipt(tx_hash, timeout=300):
-    """Wait for transaction confirmation"""
+def fetch_receipt_status(tx_hash):
+    """Get a single receipt status, or None if the transaction isn't mined yet"""
     try:
-        # FIXED: Longer timeout for testnet
-        actual_timeout = timeout * 2 if IS_TESTNET else timeout
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=actual_timeout)
-        return receipt
+        return w3.eth.get_transaction_receipt(tx_hash).status
+    except TransactionNotFound:
+        return None
     except Exception as e:
-        logger.error(f"Error waiting for receipt: {e}")
+        logger.warning(f"Error fetching receipt for {tx_hash}: {e}")
         return None
 
-def send_tokens(to_address, amount_tokens):
-    """Send tokens via Web3"""
-    try:
-        logger.info(f"Sending {amount_tokens} tokens to {to_address} on {NETWORK_NAME}")
+def wait_for_many_receipts(tx_hashes, timeout=600):
+    """Poll receipts for many transactions with one JSON-RPC batch per new block"""
+    # FIXED: Longer timeout for testnet
+    actual_timeout = timeout * 2 if IS_TESTNET else timeout
+    deadline = time.monotonic() + actual_timeout
+    pending = list(tx_hashes)
+    statuses = {}
+    last_block = None
+    
+    while pending:
+        # Receipts can only change when a block lands, so skip the batch until one does
+        try:
+            block = w3.eth.block_number
+        except Exception as e:
+            logger.warning(f"Error reading block number: {e}")
+            block = None
         
-        # Get contract and admin account
-        contract = get_contract()
-        admin_account = get_admin_account()
+        if block is not None and block == last_block:
+            if time.monotonic() >= deadline:
+                logger.error(f"Timed out waiting for {len(pending)} receipts")
+                break
+            time.sleep(RECEIPT_POLL_INTERVAL)
+            continue
+        last_block = block
+        
+        try:
+            receipts = rpc_batch(http_session, BSC_NODE_URL, [('eth_getTransactionReceipt', [tx_hash]) for tx_hash in pending])
+            results = [int(receipt['status'], 16) if receipt else None for receipt in receipts]
+        except Exception as e:
+            logger.warning(f"Receipt batch failed, polling individually: {e}")
+            results = [fetch_receipt_status(tx_hash) for tx_hash in pending]
         
-        if not contract or not admin_account:
-            logger.error("Failed to get contract or admin account")
-            return None
+        for tx_hash, status in zip(pending, results):
+            if status is not None:
+                statuses[tx_hash] = status
+        pending = [tx_hash for tx_hash in pending if tx_hash not in statuses]
         
+        if pending:
+            if time.monotonic() >= deadline:
+                logger.error(f"Timed out waiting for {len(pending)} receipts")
+                break
+            time.sleep(RECEIPT_POLL_INTERVAL)
+    
+    return statuses
+
+class RateLimiter:
+    """Token bucket allowing max_per_sec calls, blocking callers while it is empty"""
+    
+    def __init__(self, max_per_sec):
+        self.rate = max_per_sec
+        self.tokens = max_per_sec
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Pace broadcasts to what the RPC provider tolerates instead of sleeping between sends
+SEND_RATE_LIMIT = float(os.getenv("SEND_RATE_LIMIT", "5"))
+_send_limiter = RateLimiter(SEND_RATE_LIMIT)
+
+def broadcast_transaction(signed_txn):
+    """Send a signed transaction, treating a duplicate of an earlier attempt as sent"""
+    _send_limiter.acquire()
+    try:
+        return w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+    except ValueError as e:
+        if 'already known' in str(e).lower():
+            return signed_txn.hash
+        raise
+
+def to_wei(amount):
+    """Convert a token amount from the database to an integer number of wei"""
+    text = str(amount)
+    whole, _, frac = text.partition('.')
+    # Plain decimal strings convert with integer math; anything else (exponents, excess precision) goes through Decimal
+    if whole.isdigit() and (not frac or frac.isdigit()) and len(frac) <= TOKEN_DECIMALS:
+        return int(whole) * TOKEN_UNIT + int(frac.ljust(TOKEN_DECIMALS, '0') or 0)
+    return int(Decimal(text) * TOKEN_UNIT)
+
+def send_tokens_wei(to_address, amount_wei):
+    """Broadcast a token transfer and return its hash without waiting for confirmation"""
+    nonce = None
+    attempts = 0
+    try:
         # Convert to checksum address
         to_address = Web3.to_checksum_address(to_address)
         
-        # Get token decimals
-        decimals = contract.functions.decimals().call()
-        
-        # Convert amount to wei (smallest unit)
-        amount_wei = int(Decimal(str(amount_tokens)) * (10 ** decimals))
-        
-        logger.info(f"Amount in wei: {amount_wei}")
-        
-        # Check admin balance
-        admin_balance = contract.functions.balanceOf(admin_account.address).call()
-        if admin_balance < amount_wei:
-            logger.error(f"Insufficient balance. Need: {amount_wei}, Have: {admin_balance}")
-            return None
-        
-        # FIXED: Get nonce with proper parameter
-        nonce = w3.eth.get_transaction_count(admin_account.address, 'pending')
-        
-        # Get gas price and estimate gas
-        gas_price = get_gas_price()
-        gas_limit = estimate_gas(contract, admin_account.address, to_address, amount_wei)
+        # Balance sufficiency is checked once per cycle by the caller
+        fee_fields = get_fee_fields()
         
-        logger.info(f"Gas price: {w3.from_wei(gas_price, 'gwei')} gwei, Gas limit: {gas_limit}")
+        calldata = encode_transfer(to_address, amount_wei)
+        nonce = _assign_nonce()
         
         # FIXED: Use correct chain ID
-        transaction = contract.functions.transfer(
-            to_address,
-            amount_wei
-        ).build_transaction({
+        transaction = {
             'chainId': CHAIN_ID,  # Use dynamic chain ID
-            'gas': gas_limit,
-            'gasPrice': gas_price,
+            'to': CONTRACT_ADDR,
+            'value': 0,
+            'data': calldata,
+            'gas': TRANSFER_GAS_LIMIT,
+            **fee_fields,
             'nonce': nonce,
-        })
+        }
         
-        logger.info(f"Transaction built for {NETWORK_NAME}")
+        # Sign and send transaction
+        signed_txn = ADMIN_ACCOUNT.sign_transaction(transaction)
         
-        # Sign transaction
-        signed_txn = w3.eth.account.sign_transaction(transaction, ADMIN_PRIVATE_KEY)
+        def broadcast():
+            nonlocal attempts
+            attempts += 1
+            return broadcast_transaction(signed_txn)
         
-        # Send transaction
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-        tx_hash_hex = tx_hash.hex()
-        
-        logger.info(f"Transaction sent: {tx_hash_hex}")
-        
-        # Wait for confirmation
-        receipt = wait_for_transaction_receipt(tx_hash, timeout=600)  # 10 minutes
-        
-        if receipt and receipt.status == 1:
-            logger.info(f"✅ Transaction confirmed: {tx_hash_hex}")
-            logger.info(f"Gas used: {receipt.gasUsed}/{gas_limit}")
-            return tx_hash_hex
-        else:
-            logger.error(f"❌ Transaction failed: {tx_hash_hex}")
-            return None
+        tx_hash = retry_with_backoff(broadcast, retry_on=(requests.exceptions.RequestException,))
         
+    except requests.exceptions.RequestException as e:
+        # The node may have taken it before the connection dropped: keep the hash so the
+        # receipt wait decides, and let settle_nonces() resend the same transaction
+        logger.error(f"Error sending tokens, broadcast status unknown: {e}")
+        _note_maybe_sent(signed_txn)
+        return signed_txn.hash.hex()
+    
     except Exception as e:
+        if attempts > 1 and _is_nonce_error(e):
+            # An earlier attempt timed out after the node took it, and the transfer has since
+            # been pooled or mined: keep the hash and let the receipt wait decide
+            logger.warning(f"Broadcast retry for nonce {nonce} rejected after a timeout, treating as possibly sent: {e}")
+            return signed_txn.hash.hex()
         logger.error(f"Error sending tokens: {e}")
+        # Other workers may hold later nonces, so the counter is only fixed up once the batch drains
+        if nonce is not None:
+            _note_unsent_nonce(nonce, e)
+        if _is_nonce_error(e):
+            raise
         return None
+    
+    tx_hash_hex = tx_hash.hex()
+    # Only pay for formatting the per-transfer summary when it will be emitted
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            f"Transaction sent: {tx_hash_hex} to={to_address} amount_wei={amount_wei} "
+            f"nonce={nonce} fees={fee_fields} gas={TRANSFER_GAS_LIMIT}"
+        )
+    return tx_hash_hex
 
-def process_approved_withdrawals():
-    """Process all approved withdrawals"""
+def release_withdrawals(ids):
+    """Hand claimed withdrawals back to the approved queue"""
+    if ids:
+        supabase.table('withdrawals').update({
+            'status': 'approved'
+        }).in_('id', ids).eq('status', 'processing').execute()
+
+def record_broadcast(withdrawal_id, tx_hash):
+    """Store a broadcast tx_hash before anything else happens, so a crash or receipt timeout can't lead to a refund"""
     try:
-        # Get approved withdrawals ordered by creation time
-        withdrawals = supabase.table('withdrawals').select('*').eq('status', 'approved').order('created_at').execute()
-        
-        if not withdrawals.data:
-            logger.info("No approved withdrawals to process")
-            return
-        
-        logger.info(f"Processing {len(withdrawals.data)} approved withdrawals")
+        retry_with_backoff(lambda: supabase.table('withdrawals').update({
+            'tx_hash': tx_hash
+        }).eq('id', withdrawal_id).execute())
+    except Exception as e:
+        raise RuntimeError(f"Could not record tx {tx_hash} for withdrawal {withdrawal_id}: {e}") from e
+
+def submit_withdrawal(withdrawal, amount_wei):
+    """Broadcast the transfer for a withdrawal"""
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Processing withdrawal {withdrawal['id']}: {withdrawal['amount']} tokens to {withdrawal['to_address']}")
+    tx_hash = send_tokens_wei(withdrawal['to_address'], amount_wei)
+    if tx_hash:
+        record_broadcast(withdrawal['id'], tx_hash)
+    return tx_hash
+
+WITHDRAWAL_PAGE_SIZE = 100
+MAX_WITHDRAWALS_PER_CYCLE = 200
+def claim_approved_withdrawals(limit=WITHDRAWAL_PAGE_SIZE):
+    """Atomically move the oldest approved withdrawals to processing and return them"""
+    rows = supabase.rpc('claim_approved_withdrawals', {'limit_param': limit}).execute().data
+    # UPDATE ... RETURNING has no guaranteed order
+    return sorted(rows, key=lambda row: (row['created_at'], row['id']))
+
+def validate_withdrawal_request(withdrawal):
+    """Validate a withdrawal's address and amount (no network calls); returns (is_valid, message, amount in wei)"""
+    try:
+        if not Web3.is_address(withdrawal['to_address']):
+            return False, "Invalid address", None
         
-        # Check admin balance before processing
-        admin_balance = check_contract_balance()
-        total_needed = sum(float(w['amount']) for w in withdrawals.data)
+        amount_wei = to_wei(withdrawal['amount'])
+        if amount_wei <= 0:
+            return False, "Invalid amount", None
         
-        if admin_balance < total_needed:
-            logger.warning(f"⚠️ Insufficient admin balance. Need: {total_needed:,.2f}, Have: {admin_balance:,.2f}")
-            # Continue processing what we can
+        return True, "Valid", amount_wei
         
-        successful = 0
-        failed = 0
+    except Exception as e:
+        return False, f"Validation error: {e}", None
+
+def finalize_outcomes(items):
+    """Record paid and failed withdrawals; status, ledger entry and refund for every row commit together"""
+    if items:
+        supabase.rpc('finalize_withdrawals', {'items': items, 'network_param': NETWORK_NAME}).execute()
+
+def process_withdrawal_batch(withdrawals, remaining_balance):
+    """Pay out claimed withdrawals, returning (successful, failed, skipped, remaining_balance in wei)"""
+    # Reserve balance up front, since transfers are in flight concurrently
+    batch = []
+    skipped_ids = []
+    items = []
+    for withdrawal in withdrawals:
+        is_valid, validation_msg, amount_wei = validate_withdrawal_request(withdrawal)
+        if not is_valid:
+            # Only this row fails; the rest of the page still goes out
+            logger.error(f"❌ Validation failed for {withdrawal['id']}: {validation_msg}")
+            items.append({'id': withdrawal['id'], 'status': 'failed', 'admin_note': f'Validation failed: {validation_msg}'})
+            continue
+        if remaining_balance < amount_wei:
+            logger.warning(f"Insufficient balance for withdrawal {withdrawal['id']}. Skipping.")
+            skipped_ids.append(withdrawal['id'])
+            continue
+        remaining_balance -= amount_wei
+        batch.append((withdrawal, amount_wei))
+    
+    # Hand underfunded rows back to the queue so they're retried once the wallet is topped up
+    release_withdrawals(skipped_ids)
+    
+    if not batch:
+        finalize_outcomes(items)
+        return 0, len(items), len(skipped_ids), remaining_balance
+    
+    # Broadcast every transfer first
+    with ThreadPoolExecutor(max_workers=SUBMIT_WORKERS) as executor:
+        submissions = [(withdrawal, amount_wei, executor.submit(submit_withdrawal, withdrawal, amount_wei)) for withdrawal, amount_wei in batch]
+    
+    # Every send has drained, so the shared nonce counter can be fixed up safely
+    settle_nonces()
+    
+    outcomes = []
+    retry_ids = []
+    unrecorded = []
+    for withdrawal, amount_wei, submission in submissions:
+        try:
+            outcomes.append((withdrawal, amount_wei, submission.result()))
+        except Exception as e:
+            if _is_nonce_error(e):
+                # Rejected before broadcast while the counter was off; retried next cycle
+                retry_ids.append(withdrawal['id'])
+                remaining_balance += amount_wei
+            else:
+                unrecorded.append(str(e))
+    
+    release_withdrawals(retry_ids)
+    skipped_ids += retry_ids
+    
+    # A sent transfer without a stored hash could be refunded later; stop before finalizing anything
+    if unrecorded:
+        raise RuntimeError(f"Stopping before finalize: {'; '.join(unrecorded)}")
+    
+    # Then poll every receipt together
+    statuses = wait_for_many_receipts([tx_hash for _, _, tx_hash in outcomes if tx_hash])
+    
+    for withdrawal, amount_wei, tx_hash in outcomes:
+        withdrawal_id = withdrawal['id']
+        if tx_hash and statuses.get(tx_hash) == 1:
+            items.append({'id': withdrawal_id, 'status': 'paid', 'tx_hash': tx_hash})
+            logger.info(f"✅ Withdrawal {withdrawal_id} processed successfully: {tx_hash}")
+        elif tx_hash and tx_hash not in statuses:
+            # Still in the mempool and may yet be mined: stays processing with its tx_hash for review
+            logger.warning(f"⚠️ Withdrawal {withdrawal_id} still unconfirmed: {tx_hash}")
+        else:
+            items.append({'id': withdrawal_id, 'status': 'failed', 'admin_note': f'Transaction failed on {NETWORK_NAME} - tokens refunded'})
+            logger.error(f"❌ Failed to process withdrawal {withdrawal_id} - refunding")
+            # Reverted or never sent, so no tokens left the wallet; unconfirmed ones stay reserved
+            remaining_balance += amount_wei
+    
+    finalize_outcomes(items)
+    
+    successful = sum(1 for item in items if item['status'] == 'paid')
+    return successful, len(items) - successful, len(skipped_ids), remaining_balance
+
+def process_approved_withdrawals():
+    """Process all approved withdrawals; errors propagate so the scheduler counts them"""
+    # Check admin balance before processing
+    remaining_balance = get_admin_balance_wei()
+    logger.info(f"Admin wallet balance: {remaining_balance / TOKEN_UNIT:,.2f} tokens")
+    
+    successful = 0
+    failed = 0
+    seen = 0
+    
+    # Claim a page at a time so processing starts immediately and parallel processors never overlap
+    while seen < MAX_WITHDRAWALS_PER_CYCLE:
+        page = claim_approved_withdrawals(min(WITHDRAWAL_PAGE_SIZE, MAX_WITHDRAWALS_PER_CYCLE - seen))
+        if not page:
+            break
         
-        for withdrawal in withdrawals.data:
-            try:
-                withdrawal_id = withdrawal['id']
-                to_address = withdrawal['to_address']
-                amount = float(withdrawal['amount'])
-                user_id = withdrawal['user_id']
-                
-                logger.info(f"Processing withdrawal {withdrawal_id}: {amount} tokens to {to_address}")
-                
-                # FIXED: Check if we have enough balance for this specific withdrawal
-                current_balance = check_contract_balance()
-                if current_balance < amount:
-                    logger.warning(f"Insufficient balance for withdrawal {withdrawal_id}. Skipping.")
-                    continue
-                
-                # Mark as processing
-                supabase.table('withdrawals').update({
-                    'status': 'processing',
-                    'processed_at': 'now()'
-                }).eq('id', withdrawal_id).execute()
-                
-                # Send transaction
-                tx_hash = send_tokens(to_address, amount)
-                
-                if tx_hash:
-                    # Mark as paid
-                    supabase.table('withdrawals').update({
-                        'status': 'paid',
-                        'tx_hash': tx_hash,
-                        'processed_at': 'now()',
-                        'network': NETWORK_NAME
-                    }).eq('id', withdrawal_id).execute()
-                    
-                    # Log successful transaction
-                    supabase.table('transactions').insert({
-                        'user_id': user_id,
-                        'type': 'withdrawal_paid',
-                        'amount': str(-amount),  # Negative for outgoing
-                        'description': f'Withdrawal paid on {NETWORK_NAME} - TX: {tx_hash}',
-                        'reference_id': withdrawal_id
-                    }).execute()
-                    
-                    logger.info(f"✅ Withdrawal {withdrawal_id} processed successfully: {tx_hash}")
-                    successful += 1
-                    
-                    # FIXED: Longer delay between transactions for testnet
-                    delay = 10 if IS_TESTNET else 5
-                    time.sleep(delay)
-                    
-                else:
-                    # Mark as failed and refund
-                    supabase.table('withdrawals').update({
-                        'status': 'failed',
-                        'admin_note': f'Transaction failed on {NETWORK_NAME} - tokens refunded'
-                    }).eq('id', withdrawal_id).execute()
-                    
-                    # Refund user balance
-                    supabase.rpc('add_balance', {
-                        'user_id_param': user_id,
-                        'amount_param': str(amount),
-                        'type_param': 'refund',
-                        'description_param': f'Refund for failed withdrawal #{withdrawal_id}'
-                    }).execute()
-                    
-                    logger.error(f"❌ Failed to process withdrawal {withdrawal_id} - refunded")
-                    failed += 1
-                    
-            except Exception as e:
-                logger.error(f"Error processing withdrawal {withdrawal['id']}: {e}")
-                failed += 1
-                
-                # Mark as failed and refund
-                try:
-                    supabase.table('withdrawals').update({
-                        'status': 'failed',
-                        'admin_note': f'Processing error: {str(e)[:200]}'
-                    }).eq('id', withdrawal['id']).execute()
-                    
-                    # Refund user balance
-                    supabase.rpc('add_balance', {
-                        'user_id_param': withdrawal['user_id'],
-                        'amount_param': str(withdrawal['amount']),
-                        'type_param': 'refund',
-                        'description_param': f'Refund for failed withdrawal #{withdrawal["id"]}'
-                    }).execute()
-                    
-                except Exception as refund_error:
-                    logger.error(f"Error refunding withdrawal {withdrawal['id']}: {refund_error}")
-                
-                # Continue with next withdrawal
-                continue
+        seen += len(page)
+        logger.info(f"Processing {len(page)} approved withdrawals")
+        page_successful, page_failed, page_skipped, remaining_balance = process_withdrawal_batch(page, remaining_balance)
+        successful += page_successful
+        failed += page_failed
         
-        logger.info(f"📊 Batch complete: {successful} successful, {failed} failed")
-                
-    except Exception as e:
-        logger.error(f"Error in process_approved_withdrawals: {e}")
+        # Skipped rows went back to approved and would be claimed again straight away
+        if page_skipped:
+            break
+    
+    if not seen:
+        logger.info("No approved withdrawals to process")
+        return
+    
+    logger.info(f"📊 Batch complete: {successful} successful, {failed} failed")
 
+STUCK_CUTOFF_MINUTES = 30
 def cleanup_old_processing():
     """Clean up old processing withdrawals (stuck transactions)"""
     try:
-        # FIXED: Proper timestamp handling
-        cutoff_time = datetime.now() - timedelta(minutes=30)
+        # Filter, fail and refund happen in one database transaction; rows with a
+        # broadcast tx_hash (from either processor) are only counted for review
+        result = supabase.rpc('fail_stuck_withdrawals', {'cutoff_minutes': STUCK_CUTOFF_MINUTES}).execute().data
         
-        # Get withdrawals stuck in processing
-        result = supabase.table('withdrawals').select('*').eq('status', 'processing').execute()
+        if result['needs_review']:
+            logger.warning(f"⚠️ {result['needs_review']} processing withdrawals have a broadcast transaction and need review")
         
-        stuck_count = 0
-        for withdrawal in result.data:
-            try:
-                # Parse the processed_at timestamp
-                processed_at = withdrawal.get('processed_at')
-                if processed_at:
-                    # Convert ISO timestamp to datetime
-                    processed_time = datetime.fromisoformat(processed_at.replace('Z', '+00:00'))
-                    
-                    if processed_time < cutoff_time:
-                        # Mark as failed and refund
-                        supabase.table('withdrawals').update({
-                            'status': 'failed',
-                            'admin_note': 'Stuck in processing - auto-failed and refunded'
-                        }).eq('id', withdrawal['id']).execute()
-                        
-                        # Refund balance
-                        supabase.rpc('add_balance', {
-                            'user_id_param': withdrawal['user_id'],
-                            'amount_param': str(withdrawal['amount']),
-                            'type_param': 'refund',
-                            'description_param': f'Auto-refund for stuck withdrawal #{withdrawal["id"]}'
-                        }).execute()
-                        
-                        stuck_count += 1
-                        logger.warning(f"Cleaned up stuck withdrawal {withdrawal['id']}")
-                        
-            except Exception as e:
-                logger.error(f"Error cleaning withdrawal {withdrawal['id']}: {e}")
-        
-        if stuck_count > 0:
-            logger.info(f"🧹 Cleaned up {stuck_count} stuck withdrawals")
+        if result['failed']:
+            logger.info(f"🧹 Cleaned up {result['failed']} stuck withdrawals")
         
     except Exception as e:
         logger.error(f"Error in cleanup: {e}")
@@ -447,16 +690,14 @@ def health_check():
         supabase.table('settings').select('id').limit(1).execute()
         
         # FIXED: Check admin wallet BNB balance for gas
-        admin_account = get_admin_account()
-        if admin_account:
-            bnb_balance = w3.eth.get_balance(admin_account.address)
-            bnb_balance_ether = w3.from_wei(bnb_balance, 'ether')
-            
-            min_bnb = 0.01 if IS_TESTNET else 0.1
-            if bnb_balance_ether < min_bnb:
-                logger.warning(f"⚠️ Low BNB balance for gas: {bnb_balance_ether:.4f} BNB")
-            else:
-                logger.info(f"💰 Admin BNB balance: {bnb_balance_ether:.4f} BNB")
+        bnb_balance = w3.eth.get_balance(ADMIN_ADDR)
+        bnb_balance_ether = w3.from_wei(bnb_balance, 'ether')
+        
+        min_bnb = 0.01 if IS_TESTNET else 0.1
+        if bnb_balance_ether < min_bnb:
+            logger.warning(f"⚠️ Low BNB balance for gas: {bnb_balance_ether:.4f} BNB")
+        else:
+            logger.info(f"💰 Admin BNB balance: {bnb_balance_ether:.4f} BNB")
         
         logger.info("✅ Health check passed")
         return True
@@ -465,8 +706,95 @@ def health_check():
         logger.error(f"❌ Health check failed: {e}")
         return False
 
+# FIXED: Different intervals for testnet vs mainnet
+PROCESS_INTERVAL = 30 if IS_TESTNET else 60
+CLEANUP_INTERVAL = 300
+HEALTH_INTERVAL = 600
+MAX_CONSECUTIVE_ERRORS = 5
+
+async def _every(interval, job):
+    """Run a blocking job in a worker thread every `interval` seconds"""
+    consecutive_errors = 0
+    while True:
+        try:
+            await asyncio.to_thread(job)
+            consecutive_errors = 0
+        except Exception as e:
+            consecutive_errors += 1
+            logger.error(f"❌ Error in {job.__name__} (#{consecutive_errors}): {e}")
+            if consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+                logger.error(f"💥 Too many consecutive errors in {job.__name__}. Shutting down.")
+                raise
+        await asyncio.sleep(interval)
+
+async def run_scheduler():
+    """Run processing, cleanup and health checks on independent cadences"""
+    # Health already ran at startup, so its first scheduled run waits a full interval
+    async def delayed_health():
+        await asyncio.sleep(HEALTH_INTERVAL)
+        await _every(HEALTH_INTERVAL, health_check)
+    
+    await asyncio.gather(
+        _every(PROCESS_INTERVAL, process_approved_withdrawals),
+        _every(CLEANUP_INTERVAL, cleanup_old_processing),
+        delayed_health(),
+    )
+
+def _connect():
+    """Check the node is reachable and return the latest block"""
+    # FIXED: Use is_connected() instead of is_connected
+    if not w3.is_connected():
+        raise ConnectionError("Failed to connect to BSC node")
+    return w3.eth.block_number
+
+def init():
+    """Validate config, then connect to Supabase and the BSC node, retrying transient failures"""
+    global supabase, TOKEN_DECIMALS, TOKEN_UNIT, TOKEN_SYMBOL, TOKEN_NAME
+    global ADMIN_ACCOUNT, ADMIN_ADDR, CONTRACT_ADDR, _next_nonce
+    
+    # Validate required environment variables
+    required_vars = {
+        'SUPABASE_URL': SUPABASE_URL,
+        'SUPABASE_KEY': SUPABASE_KEY,
+        'CONTRACT_ADDRESS': CONTRACT_ADDRESS,
+        'ADMIN_PRIVATE_KEY': ADMIN_PRIVATE_KEY,
+    }
+    missing_vars = [name for name, value in required_vars.items() if not value]
+    if missing_vars:
+        raise RuntimeError(f"Missing required environment variables: {missing_vars}")
+    
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    
+    latest_block = retry_with_backoff(_connect, attempts=5, base_delay=1)
+    logger.info(f"Connected to {NETWORK_NAME}. Latest block: {latest_block}")
+    
+    # Derive the signer and its checksummed address once
+    ADMIN_ACCOUNT = get_admin_account()
+    contract = get_contract()
+    if not ADMIN_ACCOUNT or not contract:
+        raise RuntimeError("Failed to get contract or admin account")
+    ADMIN_ADDR = ADMIN_ACCOUNT.address
+    CONTRACT_ADDR = contract.address
+    
+    # Token metadata is immutable, so read it once at startup
+    TOKEN_DECIMALS, TOKEN_SYMBOL, TOKEN_NAME = retry_with_backoff(lambda: multicall(contract, [
+        ('decimals', [], 'uint8'),
+        ('symbol', [], 'string'),
+        ('name', [], 'string'),
+    ]), attempts=5, base_delay=1)
+    TOKEN_UNIT = 10 ** TOKEN_DECIMALS
+    
+    # Seed the local nonce counter
+    _next_nonce = retry_with_backoff(lambda: w3.eth.get_transaction_count(ADMIN_ADDR, 'pending'), attempts=5, base_delay=1)
+
 def main():
     """Main processing loop"""
+    try:
+        init()
+    except Exception as e:
+        logger.error(f"Initialization failed: {e}")
+        exit(1)
+    
     logger.info(f"🚀 Payment processor started on {NETWORK_NAME}")
     
     # Initial health check
@@ -475,61 +803,12 @@ def main():
         exit(1)
     
     # Display contract info
-    try:
-        contract = get_contract()
-        if contract:
-            symbol = contract.functions.symbol().call()
-            decimals = contract.functions.decimals().call()
-            name = contract.functions.name().call()
-            logger.info(f"🪙 Token: {name} ({symbol}), Decimals: {decimals}")
-        else:
-            logger.warning("⚠️ Contract not available - running in simulation mode")
-    except Exception as e:
-        logger.error(f"Error getting contract info: {e}")
+    logger.info(f"🪙 Token: {TOKEN_NAME} ({TOKEN_SYMBOL}), Decimals: {TOKEN_DECIMALS}")
     
-    consecutive_errors = 0
-    max_consecutive_errors = 5
-    cycle_count = 0
-    
-    while True:
-        try:
-            cycle_count += 1
-            logger.info(f"🔄 Cycle #{cycle_count}: Checking for approved withdrawals...")
-            
-            # Process withdrawals
-            process_approved_withdrawals()
-            
-            # Cleanup old processing every 5 cycles
-            if cycle_count % 5 == 0:
-                cleanup_old_processing()
-            
-            # Health check every 10 cycles
-            if cycle_count % 10 == 0:
-                health_check()
-            
-            consecutive_errors = 0
-            
-            # FIXED: Different intervals for testnet vs mainnet
-            wait_time = 30 if IS_TESTNET else 60
-            logger.info(f"✅ Cycle completed. Waiting {wait_time} seconds...")
-            time.sleep(wait_time)
-            
-        except KeyboardInterrupt:
-            logger.info("👋 Shutting down payment processor...")
-            break
-            
-        except Exception as e:
-            consecutive_errors += 1
-            logger.error(f"❌ Error in main loop (#{consecutive_errors}): {e}")
-            
-            if consecutive_errors >= max_consecutive_errors:
-                logger.error(f"💥 Too many consecutive errors ({consecutive_errors}). Shutting down.")
-                break
-            
-            # Wait longer on errors
-            error_wait = 180 if IS_TESTNET else 120
-            logger.info(f"⏳ Waiting {error_wait} seconds before retry...")
-            time.sleep(error_wait)
+    try:
+        asyncio.run(run_scheduler())
+    except KeyboardInterrupt:
+        logger.info("👋 Shutting down payment processor...")
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,16 @@
 import os
+import requests
 from web3 import Web3
-from supabase import create_client
-import json
+from supabase import create_client, ClientOptions
 import time
 import logging
+from functools import lru_cache
 from decimal import Decimal
-from datetime import datetime, timedelta, timezone
-from dateutil import parser  # Add this for robust datetime parsing
+from chain_config import (
+    SUPABASE_URL, SUPABASE_KEY, BSC_NODE_URL, CONTRACT_ADDRESS, ADMIN_PRIVATE_KEY,
+    CHAIN_ID, NETWORK_NAME, ERC20_ABI, make_http_session,
+    rpc_batch, encode_transfer
+)
 
 # Setup logging for GitHub Actions
 logging.basicConfig(
@@ -15,385 +19,351 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Configuration
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-BSC_NODE_URL = os.getenv("BSC_NODE_URL", "https://data-seed-prebsc-1-s1.binance.org:8545/")
-CONTRACT_ADDRESS = os.getenv("CONTRACT_ADDRESS")
-ADMIN_PRIVATE_KEY = os.getenv("ADMIN_PRIVATE_KEY")
-ADMIN_ADDRESS = os.getenv("ADMIN_ADDRESS")
+logger.info(f"🔗 Network: {NETWORK_NAME} (Chain ID: {CHAIN_ID})")
 
-# Determine network
-IS_TESTNET = "testnet" in BSC_NODE_URL or "prebsc" in BSC_NODE_URL
-CHAIN_ID = 97 if IS_TESTNET else 56
-NETWORK_NAME = "BSC Testnet" if IS_TESTNET else "BSC Mainnet"
+# One keep-alive session for every call to the BSC node, so the TLS handshake happens once per run
+http_session = make_http_session(pool_connections=10, pool_maxsize=10, backoff_factor=0.3)
+w3 = Web3(Web3.HTTPProvider(BSC_NODE_URL, session=http_session, request_kwargs={'timeout': 15}))
 
-logger.info(f"🔗 Network: {NETWORK_NAME} (Chain ID: {CHAIN_ID})")
+# Used when the startup gas estimate is unavailable
+TRANSFER_GAS_LIMIT = int(os.getenv("TRANSFER_GAS_LIMIT", "200000"))
 
-# Validate required environment variables
-required_vars = [SUPABASE_URL, SUPABASE_KEY, CONTRACT_ADDRESS, ADMIN_PRIVATE_KEY]
-missing_vars = [var for var in required_vars if not var]
+# Set by init() so importing this module makes no network calls
+supabase = None
+_CONTRACT = None
+_ADMIN_ACCOUNT = None
+TOKEN_DECIMALS = None
+TOKEN_UNIT = None
+GAS_LIMIT = TRANSFER_GAS_LIMIT
 
-if missing_vars:
-    logger.error(f"❌ Missing required environment variables: {missing_vars}")
-    exit(1)
+def estimate_transfer_gas():
+    """Estimate one token transfer with a 20% margin, falling back to TRANSFER_GAS_LIMIT"""
+    try:
+        # A fresh address pays for a new balance slot, like a first withdrawal to a user
+        recipient = Web3.to_checksum_address('0x' + os.urandom(20).hex())
+        estimate = _CONTRACT.functions.transfer(recipient, 1).estimate_gas({'from': _ADMIN_ACCOUNT.address})
+        return int(estimate * 1.2)
+    except Exception as e:
+        logger.warning(f"⚠️ Gas estimate failed, using {TRANSFER_GAS_LIMIT}: {e}")
+        return TRANSFER_GAS_LIMIT
 
-# Initialize
-try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    w3 = Web3(Web3.HTTPProvider(BSC_NODE_URL))
+def init():
+    """Validate config, connect to Supabase and the BSC node, and load the contract and signer"""
+    global supabase, _CONTRACT, _ADMIN_ACCOUNT, TOKEN_DECIMALS, TOKEN_UNIT, GAS_LIMIT
     
-    if not w3.is_connected():
-        logger.error("❌ Failed to connect to BSC node")
+    # Validate required environment variables
+    required_vars = [SUPABASE_URL, SUPABASE_KEY, CONTRACT_ADDRESS, ADMIN_PRIVATE_KEY]
+    missing_vars = [var for var in required_vars if not var]
+    
+    if missing_vars:
+        logger.error(f"❌ Missing required environment variables: {missing_vars}")
         exit(1)
     
-    logger.info(f"✅ Connected to {NETWORK_NAME}. Latest block: {w3.eth.block_number}")
+    try:
+        # supabase-py already reuses one HTTP/2 client for all table and rpc calls;
+        # bound each call so a hung request cannot outlast the next cron run
+        supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(postgrest_client_timeout=30))
+        
+        if not w3.is_connected():
+            logger.error("❌ Failed to connect to BSC node")
+            exit(1)
+        
+        logger.info(f"✅ Connected to {NETWORK_NAME}. Latest block: {w3.eth.block_number}")
+        
+    except Exception as e:
+        logger.error(f"❌ Initialization failed: {e}")
+        exit(1)
     
-except Exception as e:
-    logger.error(f"❌ Initialization failed: {e}")
-    exit(1)
-
-# ERC20 ABI
-ERC20_ABI = json.loads('''[
-    {
-        "constant": false,
-        "inputs": [
-            {"name": "_to", "type": "address"},
-            {"name": "_value", "type": "uint256"}
-        ],
-        "name": "transfer",
-        "outputs": [{"name": "", "type": "bool"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [{"name": "_owner", "type": "address"}],
-        "name": "balanceOf",
-        "outputs": [{"name": "balance", "type": "uint256"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [],
-        "name": "decimals",
-        "outputs": [{"name": "", "type": "uint8"}],
-        "type": "function"
-    },
-    {
-        "constant": true,
-        "inputs": [],
-        "name": "symbol",
-        "outputs": [{"name": "", "type": "string"}],
-        "type": "function"
-    }
-]''')
-
-def get_contract():
-    """Get contract instance"""
+    # Build the contract and signer once, and read the immutable token decimals
     try:
-        return w3.eth.contract(
+        _CONTRACT = w3.eth.contract(
             address=Web3.to_checksum_address(CONTRACT_ADDRESS), 
             abi=ERC20_ABI
         )
+        _ADMIN_ACCOUNT = w3.eth.account.from_key(ADMIN_PRIVATE_KEY)
+        TOKEN_DECIMALS = _CONTRACT.functions.decimals().call()
+        TOKEN_UNIT = 10 ** TOKEN_DECIMALS
     except Exception as e:
-        logger.error(f"Error getting contract: {e}")
-        return None
+        logger.error(f"❌ Failed to load contract or admin account: {e}")
+        exit(1)
+    
+    GAS_LIMIT = estimate_transfer_gas()
+
+def get_contract():
+    """Get contract instance"""
+    return _CONTRACT
 
 def get_admin_account():
     """Get admin account from private key"""
-    try:
-        return w3.eth.account.from_key(ADMIN_PRIVATE_KEY)
-    except Exception as e:
-        logger.error(f"Error getting admin account: {e}")
-        return None
+    return _ADMIN_ACCOUNT
+
+# Optional fixed tip / legacy gas price in gwei; 0 follows the node's eth_gasPrice
+GAS_PRICE_WEI = int(Decimal(os.getenv("GAS_PRICE_GWEI", "0")) * 10 ** 9)
 
-def check_contract_balance():
-    """Check admin wallet token balance"""
+def fee_fields(gas_price, base_fee):
+    """EIP-1559 fee fields when the chain reports a base fee, legacy gasPrice otherwise"""
+    gas_price = GAS_PRICE_WEI or int(gas_price * 1.2)
+    if base_fee is None:
+        return {'gasPrice': gas_price}
+    # BSC validators enforce a floor on the tip, so never bid below the legacy price
+    return {'maxFeePerGas': base_fee * 2 + gas_price, 'maxPriorityFeePerGas': gas_price}
+
+def preflight():
+    """Read the admin nonce, fees, chain id and token balance (wei) in one round-trip"""
+    admin_address = get_admin_account().address
+    balance_call = {
+        'to': get_contract().address,
+        'data': get_contract().encodeABI(fn_name='balanceOf', args=[admin_address])
+    }
     try:
-        contract = get_contract()
-        admin_account = get_admin_account()
-        
-        if not contract or not admin_account:
-            return 0
-        
-        balance = contract.functions.balanceOf(admin_account.address).call()
-        decimals = contract.functions.decimals().call()
-        token_balance = balance / (10 ** decimals)
-        
-        logger.info(f"💰 Admin wallet balance: {token_balance:,.2f} tokens")
-        return token_balance
-        
+        nonce, gas_price, latest_block, chain_id, balance = rpc_batch(http_session, BSC_NODE_URL, [
+            ('eth_getTransactionCount', [admin_address, 'pending']),
+            ('eth_gasPrice', []),
+            ('eth_getBlockByNumber', ['latest', False]),
+            ('eth_chainId', []),
+            ('eth_call', [balance_call, 'latest']),
+        ])
+        nonce, gas_price, chain_id, balance = (int(value, 16) for value in (nonce, gas_price, chain_id, balance))
+        base_fee = latest_block.get('baseFeePerGas')
+        base_fee = int(base_fee, 16) if base_fee is not None else None
     except Exception as e:
-        logger.error(f"Error checking balance: {e}")
-        return 0
+        # Some providers reject JSON-RPC batches; the same reads one by one still work
+        logger.warning(f"Batch pre-flight read failed, falling back to individual calls: {e}")
+        nonce = w3.eth.get_transaction_count(admin_address, 'pending')
+        gas_price = w3.eth.gas_price
+        base_fee = w3.eth.get_block('latest').get('baseFeePerGas')
+        chain_id = w3.eth.chain_id
+        balance = get_contract().functions.balanceOf(admin_address).call()
+    
+    if chain_id != CHAIN_ID:
+        raise ValueError(f"Node is on chain {chain_id}, expected {CHAIN_ID}")
+    
+    logger.info(f"💰 Admin wallet balance: {balance / TOKEN_UNIT:,.2f} tokens")
+    return nonce, fee_fields(gas_price, base_fee), balance
+
+@lru_cache(maxsize=1024)
+def checksum_address(address):
+    """Checksummed form of an address, cached since users withdraw to the same wallets repeatedly"""
+    return Web3.to_checksum_address(address)
 
-def send_tokens(to_address, amount_tokens):
-    """Send tokens via Web3"""
+def sign_transfer(to_address, amount_wei, nonce, fees):
+    """Build and sign a token transfer with an explicit nonce"""
+    transaction = {
+        'chainId': CHAIN_ID,
+        'to': get_contract().address,
+        'value': 0,
+        'data': encode_transfer(checksum_address(to_address), amount_wei),
+        'gas': GAS_LIMIT,
+        'nonce': nonce,
+        **fees,
+    }
+    
+    return get_admin_account().sign_transaction(transaction)
+
+def record_broadcast(withdrawal_id, tx_hash_hex):
+    """Store a broadcast tx_hash before anything else happens, so a crash or receipt timeout can't lead to a refund"""
     try:
-        logger.info(f"💰 Sending {amount_tokens} tokens to {to_address}")
-        
-        contract = get_contract()
-        admin_account = get_admin_account()
-        
-        if not contract or not admin_account:
-            logger.error("Failed to get contract or admin account")
-            return None
-        
-        # Convert to checksum address
-        to_address = Web3.to_checksum_address(to_address)
-        
-        # Get token decimals
-        decimals = contract.functions.decimals().call()
-        amount_wei = int(Decimal(str(amount_tokens)) * (10 ** decimals))
-        
-        # Check balance
-        admin_balance = contract.functions.balanceOf(admin_account.address).call()
-        if admin_balance < amount_wei:
-            logger.error(f"Insufficient balance. Need: {amount_wei}, Have: {admin_balance}")
-            return None
-        
-        # Get transaction parameters
-        nonce = w3.eth.get_transaction_count(admin_account.address, 'pending')
-        gas_price = w3.eth.gas_price
-        
-        # Build transaction
-        transaction = contract.functions.transfer(
-            to_address, amount_wei
-        ).build_transaction({
-            'chainId': CHAIN_ID,
-            'gas': 200000,
-            'gasPrice': int(gas_price * 1.2),
-            'nonce': nonce,
-        })
-        
-        # Sign and send
-        signed_txn = w3.eth.account.sign_transaction(transaction, ADMIN_PRIVATE_KEY)
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-        tx_hash_hex = tx_hash.hex()
-        
-        logger.info(f"📤 Transaction sent: {tx_hash_hex}")
-        
-        # Wait for confirmation
-        receipt = w3.eth.wait_for_transaction_receipt(tx_hash, timeout=300)
-        
-        if receipt and receipt.status == 1:
-            logger.info(f"✅ Transaction confirmed: {tx_hash_hex}")
-            return tx_hash_hex
-        else:
-            logger.error(f"❌ Transaction failed: {tx_hash_hex}")
-            return None
-            
+        supabase.table('withdrawals').update({'tx_hash': tx_hash_hex}).eq('id', withdrawal_id).execute()
     except Exception as e:
-        logger.error(f"Error sending tokens: {e}")
-        return None
+        raise RuntimeError(f"Could not record tx {tx_hash_hex} for withdrawal {withdrawal_id}: {e}") from e
+
+def send_batch(withdrawals, nonce, fees):
+    """Sign and broadcast one transfer per (withdrawal, amount_wei) with consecutive nonces"""
+    admin_address = get_admin_account().address
+    
+    tx_hashes = {}
+    for withdrawal, amount_wei in withdrawals:
+        try:
+            signed_txn = sign_transfer(withdrawal['to_address'], amount_wei, nonce, fees)
+            tx_hash = w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except requests.RequestException as e:
+            # The node may have taken it before the connection dropped: keep the hash so the row
+            # stays processing for the receipt wait and stuck handling instead of being refunded
+            logger.error(f"Error sending tokens for withdrawal {withdrawal['id']}, broadcast status unknown: {e}")
+            tx_hash = signed_txn.hash
+            try:
+                # The identical transaction can only land once; resending fills the nonce if the first never arrived
+                w3.eth.send_raw_transaction(signed_txn.rawTransaction)
+            except Exception as resend_error:
+                logger.warning(f"Resend for withdrawal {withdrawal['id']} failed: {resend_error}")
+        except Exception as e:
+            logger.error(f"Error sending tokens for withdrawal {withdrawal['id']}: {e}")
+            # Re-read the nonce so a rejected transaction doesn't leave a gap
+            try:
+                nonce = w3.eth.get_transaction_count(admin_address, 'pending')
+            except Exception as nonce_error:
+                logger.error(f"Error refreshing nonce, stopping sends: {nonce_error}")
+                break
+            continue
+        
+        tx_hashes[withdrawal['id']] = tx_hash
+        logger.info("📤 Sent %s tokens to %s (nonce %s): %s", withdrawal['amount'], withdrawal['to_address'], nonce, tx_hash.hex())
+        nonce += 1
+        # Not caught: a sent transfer without a stored hash must never reach finalize or a refund
+        record_broadcast(withdrawal['id'], tx_hash.hex())
+    
+    return tx_hashes
+
+RECEIPT_POLL_INTERVAL = 3
+def wait_for_receipts(tx_hashes, timeout=300):
+    """Poll all outstanding receipts in one JSON-RPC batch per round; returns {withdrawal_id: tx_hash_hex or None}"""
+    deadline = time.monotonic() + timeout
+    pending = {withdrawal_id: tx_hash.hex() for withdrawal_id, tx_hash in tx_hashes.items()}
+    results = {}
+    
+    while pending:
+        try:
+            receipts = rpc_batch(http_session, BSC_NODE_URL, [('eth_getTransactionReceipt', [tx_hash_hex]) for tx_hash_hex in pending.values()])
+        except Exception as e:
+            logger.warning(f"Error polling receipts: {e}")
+            receipts = [None] * len(pending)
+        
+        for (withdrawal_id, tx_hash_hex), receipt in zip(list(pending.items()), receipts):
+            if receipt:
+                results[withdrawal_id] = tx_hash_hex if int(receipt['status'], 16) == 1 else None
+                del pending[withdrawal_id]
+        
+        if pending:
+            if time.monotonic() >= deadline:
+                # Left out of results: these may still be mined, so they must not be refunded
+                logger.error(f"Timed out waiting for {len(pending)} receipts")
+                break
+            time.sleep(RECEIPT_POLL_INTERVAL)
+    
+    return results
 
 def validate_withdrawal_request(withdrawal):
-    """Validate withdrawal before processing"""
+    """Validate a withdrawal's address and amount (no network calls); returns (is_valid, message, amount in wei)"""
     try:
         # Check if address is valid
-        Web3.to_checksum_address(withdrawal['to_address'])
-        
-        # Check amount is positive
-        amount = float(withdrawal['amount'])
-        if amount <= 0:
-            return False, "Invalid amount"
+        if not Web3.is_address(withdrawal['to_address']):
+            return False, "Invalid address", None
         
-        # Check admin balance
-        admin_balance = check_contract_balance()
-        if admin_balance < amount:
-            return False, f"Insufficient admin balance: {admin_balance}"
+        # Convert to wei once; str() keeps a JSON float from picking up binary noise
+        amount_wei = int(Decimal(str(withdrawal['amount'])) * TOKEN_UNIT)
+        if amount_wei <= 0:
+            return False, "Invalid amount", None
         
-        return True, "Valid"
+        return True, "Valid", amount_wei
         
     except Exception as e:
-        return False, f"Validation error: {e}"
+        return False, f"Validation error: {e}", None
 
+def release_withdrawals(ids):
+    """Hand claimed withdrawals back to the approved queue"""
+    if ids:
+        supabase.table('withdrawals').update({
+            'status': 'approved'
+        }).in_('id', ids).eq('status', 'processing').execute()
+
+BATCH_SIZE = 5
 def process_single_batch():
     """Process a single batch of withdrawals (GitHub Actions optimized)"""
     try:
         logger.info("🔍 Checking for approved withdrawals...")
         
-        # Get up to 5 approved withdrawals
-        withdrawals = supabase.table('withdrawals').select('*').eq('status', 'approved').order('created_at').limit(5).execute()
+        # Atomically move up to BATCH_SIZE approved withdrawals to processing, so overlapping runs never share a row
+        withdrawals = supabase.rpc('claim_approved_withdrawals', {'limit_param': BATCH_SIZE}).execute()
         
         if not withdrawals.data:
             logger.info("✅ No approved withdrawals to process")
             return
         
-        logger.info(f"📋 Processing {len(withdrawals.data)} withdrawals")
+        # UPDATE ... RETURNING has no guaranteed order
+        claimed = sorted(withdrawals.data, key=lambda row: (row['created_at'], row['id']))
+        logger.info(f"📋 Processing {len(claimed)} withdrawals")
+        
+        # Phase 1: address and amount checks need no network access
+        checked = [(w, *validate_withdrawal_request(w)) for w in claimed]
         
-        # Check admin balance first
-        admin_balance = check_contract_balance()
-        total_needed = sum(float(w['amount']) for w in withdrawals.data)
+        # Check admin balance first, reading the send parameters in the same request
+        try:
+            nonce, fees, admin_balance = preflight()
+        except Exception:
+            release_withdrawals([w['id'] for w in claimed])
+            raise
+        total_needed = sum(amount_wei for _, is_valid, _, amount_wei in checked if is_valid)
         
         if admin_balance < total_needed:
-            logger.warning(f"⚠️ Insufficient balance. Need: {total_needed}, Have: {admin_balance}")
+            logger.warning(f"⚠️ Insufficient balance. Need: {total_needed / TOKEN_UNIT:,.2f}, Have: {admin_balance / TOKEN_UNIT:,.2f}")
         
-        successful = 0
-        failed = 0
+        # Nothing to fail and nothing affordable: leave every row approved for the next run
+        if all(is_valid for _, is_valid, _, _ in checked) and admin_balance < min(amount_wei for _, _, _, amount_wei in checked):
+            logger.warning("⚠️ Admin balance below the smallest withdrawal, skipping batch")
+            release_withdrawals([w['id'] for w in claimed])
+            return
         
-        for withdrawal in withdrawals.data:
-            try:
-                withdrawal_id = withdrawal['id']
-                to_address = withdrawal['to_address']
-                amount = float(withdrawal['amount'])
-                user_id = withdrawal['user_id']
-                
-                logger.info(f"💳 Processing withdrawal {withdrawal_id}: {amount} tokens to {to_address}")
-                
-                # Validate withdrawal
-                is_valid, validation_msg = validate_withdrawal_request(withdrawal)
-                if not is_valid:
-                    logger.error(f"❌ Validation failed for {withdrawal_id}: {validation_msg}")
-                    
-                    # Mark as failed and refund
-                    supabase.table('withdrawals').update({
-                        'status': 'failed',
-                        'admin_note': f'Validation failed: {validation_msg}'
-                    }).eq('id', withdrawal_id).execute()
-                    
-                    # Refund user
-                    supabase.rpc('add_balance', {
-                        'user_id_param': user_id,
-                        'amount_param': str(amount),
-                        'type_param': 'refund',
-                        'description_param': f'Refund for failed withdrawal #{withdrawal_id}'
-                    }).execute()
-                    
-                    failed += 1
-                    continue
-                
-                # Mark as processing
-                supabase.table('withdrawals').update({
-                    'status': 'processing',
-                    'processed_at': 'now()'
-                }).eq('id', withdrawal_id).execute()
-                
-                # Send actual transaction
-                tx_hash = send_tokens(to_address, amount)
-                
-                if tx_hash:
-                    # Mark as paid
-                    supabase.table('withdrawals').update({
-                        'status': 'paid',
-                        'tx_hash': tx_hash,
-                        'processed_at': 'now()',
-                        'network': NETWORK_NAME
-                    }).eq('id', withdrawal_id).execute()
-                    
-                    # Log transaction
-                    supabase.table('transactions').insert({
-                        'user_id': user_id,
-                        'type': 'withdrawal_paid',
-                        'amount': str(-amount),
-                        'description': f'Withdrawal paid on {NETWORK_NAME} - TX: {tx_hash}',
-                        'reference_id': withdrawal_id
-                    }).execute()
-                    
-                    logger.info(f"✅ Withdrawal {withdrawal_id} processed successfully: {tx_hash}")
-                    successful += 1
-                else:
-                    # Mark as failed and refund
-                    supabase.table('withdrawals').update({
-                        'status': 'failed',
-                        'admin_note': f'Transaction failed on {NETWORK_NAME}'
-                    }).eq('id', withdrawal_id).execute()
-                    
-                    # Refund user balance
-                    supabase.rpc('add_balance', {
-                        'user_id_param': user_id,
-                        'amount_param': str(amount),
-                        'type_param': 'refund',
-                        'description_param': f'Refund for failed withdrawal #{withdrawal_id}'
-                    }).execute()
-                    
-                    logger.error(f"❌ Failed to process withdrawal {withdrawal_id}")
-                    failed += 1
-                
-                # Delay between transactions
-                time.sleep(5)
-                
-            except Exception as e:
-                logger.error(f"❌ Error processing withdrawal {withdrawal['id']}: {e}")
-                
-                # Mark as failed and refund
-                try:
-                    supabase.table('withdrawals').update({
-                        'status': 'failed',
-                        'admin_note': f'Processing error: {str(e)[:200]}'
-                    }).eq('id', withdrawal['id']).execute()
-                    
-                    supabase.rpc('add_balance', {
-                        'user_id_param': withdrawal['user_id'],
-                        'amount_param': str(withdrawal['amount']),
-                        'type_param': 'refund',
-                        'description_param': f'Refund for failed withdrawal #{withdrawal["id"]}'
-                    }).execute()
-                except Exception as refund_error:
-                    logger.error(f"Error refunding: {refund_error}")
-                
-                failed += 1
+        # Outcomes are collected here and recorded in one transaction after the batch
+        outcomes = []
+        to_send = []
+        skipped = []
         
-        logger.info(f"📊 Batch complete: {successful} successful, {failed} failed")
+        # Phase 2: reserve balance for the oldest valid withdrawals the wallet can cover
+        for withdrawal, is_valid, validation_msg, amount_wei in checked:
+            withdrawal_id = withdrawal['id']
+            
+            if is_valid and (skipped or admin_balance < amount_wei):
+                # Goes back to approved so it's retried, in order, once the wallet is topped up
+                logger.warning("⚠️ Insufficient balance for withdrawal %s, returning it to approved", withdrawal_id)
+                skipped.append(withdrawal_id)
+                continue
+            
+            if not is_valid:
+                logger.error("❌ Validation failed for %s: %s", withdrawal_id, validation_msg)
+                outcomes.append({'id': withdrawal_id, 'status': 'failed', 'admin_note': f'Validation failed: {validation_msg}'})
+                continue
+            
+            admin_balance -= amount_wei
+            to_send.append((withdrawal, amount_wei))
+        
+        release_withdrawals(skipped)
+        
+        if to_send:
+            # Broadcast back-to-back, then wait for all confirmations together
+            tx_hashes = send_batch(to_send, nonce, fees)
+            results = wait_for_receipts(tx_hashes)
+        else:
+            tx_hashes = results = {}
+        
+        for withdrawal, _ in to_send:
+            withdrawal_id = withdrawal['id']
+            if withdrawal_id in tx_hashes and withdrawal_id not in results:
+                # Broadcast but unconfirmed: stays processing with its tx_hash for review
+                logger.warning("⚠️ Withdrawal %s still unconfirmed: %s", withdrawal_id, tx_hashes[withdrawal_id].hex())
+                continue
+            
+            tx_hash = results.get(withdrawal_id)
+            if tx_hash:
+                outcomes.append({'id': withdrawal_id, 'status': 'paid', 'tx_hash': tx_hash})
+                logger.info("✅ Withdrawal %s paid %s tokens to %s: %s", withdrawal_id, withdrawal['amount'], withdrawal['to_address'], tx_hash)
+            else:
+                outcomes.append({'id': withdrawal_id, 'status': 'failed', 'admin_note': f'Transaction failed on {NETWORK_NAME}'})
+                logger.error("❌ Withdrawal %s failed (tx %s), refunding", withdrawal_id, tx_hashes[withdrawal_id].hex() if withdrawal_id in tx_hashes else 'not sent')
+        
+        # Status, ledger entry and refund for every row commit together
+        if outcomes:
+            supabase.rpc('finalize_withdrawals', {'items': outcomes, 'network_param': NETWORK_NAME}).execute()
+        
+        paid = sum(1 for outcome in outcomes if outcome['status'] == 'paid')
+        logger.info(f"📊 Batch complete: {paid} successful, {len(outcomes) - paid} failed, {len(skipped)} skipped")
         
     except Exception as e:
         logger.error(f"❌ Error in process_single_batch: {e}")
+        # Fail the run so stuck-row cleanup doesn't refund anything this batch left half-done
+        raise
 
+STUCK_CUTOFF_MINUTES = 10
 def cleanup_stuck_withdrawals():
     """Clean up withdrawals stuck in processing"""
     try:
-        # Import timezone for proper datetime handling
-        from datetime import timezone
-        
-        # Create timezone-aware cutoff time
-        cutoff_time = datetime.now(timezone.utc) - timedelta(minutes=10)
+        # Filter, fail and refund happen in one database transaction
+        result = supabase.rpc('fail_stuck_withdrawals', {'cutoff_minutes': STUCK_CUTOFF_MINUTES}).execute().data
         
-        result = supabase.table('withdrawals').select('*').eq('status', 'processing').execute()
-        
-        cleaned = 0
-        for withdrawal in result.data:
-            try:
-                processed_at = withdrawal.get('processed_at')
-                if processed_at:
-                    # Handle different timestamp formats from Supabase
-                    if isinstance(processed_at, str):
-                        # Remove 'Z' and add timezone info, or handle +00:00 format
-                        if processed_at.endswith('Z'):
-                            processed_at = processed_at.replace('Z', '+00:00')
-                        
-                        # Parse the timestamp (this will be timezone-aware)
-                        from dateutil import parser
-                        processed_time = parser.parse(processed_at)
-                    else:
-                        # If it's already a datetime object, ensure it's timezone-aware
-                        processed_time = processed_at
-                        if processed_time.tzinfo is None:
-                            processed_time = processed_time.replace(tzinfo=timezone.utc)
-                    
-                    # Now both datetimes are timezone-aware, safe to compare
-                    if processed_time < cutoff_time:
-                        # Mark as failed and refund
-                        supabase.table('withdrawals').update({
-                            'status': 'failed',
-                            'admin_note': 'Stuck in processing - auto-failed'
-                        }).eq('id', withdrawal['id']).execute()
-                        
-                        # Refund balance
-                        supabase.rpc('add_balance', {
-                            'user_id_param': withdrawal['user_id'],
-                            'amount_param': str(withdrawal['amount']),
-                            'type_param': 'refund',
-                            'description_param': f'Auto-refund for stuck withdrawal #{withdrawal["id"]}'
-                        }).execute()
-                        
-                        cleaned += 1
-                        logger.info(f"🧹 Cleaned stuck withdrawal {withdrawal['id']}")
-                        
-            except Exception as e:
-                logger.error(f"Error cleaning withdrawal {withdrawal['id']}: {e}")
+        if result['needs_review']:
+            logger.warning(f"⚠️ {result['needs_review']} processing withdrawals have a broadcast transaction and need review")
         
-        if cleaned > 0:
-            logger.info(f"🧹 Cleaned up {cleaned} stuck withdrawals")
+        if result['failed']:
+            logger.info(f"🧹 Cleaned up {result['failed']} stuck withdrawals")
         else:
             logger.info("✅ No stuck withdrawals found")
         
@@ -402,6 +372,7 @@ def cleanup_stuck_withdrawals():
 
 if __name__ == "__main__":
     logger.info("🚀 Payment processor started (GitHub Actions mode)")
+    init()
     
     try:
         # Process current batch
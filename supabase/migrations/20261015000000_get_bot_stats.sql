@@ -0,0 +1,15 @@
+-- Aggregated counters for the /stats admin command.
+-- Returns a single JSON object so the bot no longer has to download the
+-- users, referrals and withdrawals tables to count and sum them.
+create or replace function get_bot_stats()
+returns json
+language sql
+stable
+as $$
+    select json_build_object(
+        'total_users', (select count(*) from users),
+        'total_balance', (select coalesce(sum(balance::numeric), 0) from users),
+        'total_referrals', (select count(*) from referrals),
+        'pending_withdrawals', (select count(*) from withdrawals where status = 'pending')
+    );
+$$;
@@ -0,0 +1,15 @@
+-- User row plus referral and withdrawal counts for the /userinfo admin
+-- command, in a single round trip. Returns NULL for an unknown user.
+create or replace function admin_user_summary(user_id_param bigint)
+returns json
+language sql
+stable
+as $$
+    select json_build_object(
+        'user', row_to_json(u),
+        'referral_count', (select count(*) from referrals where inviter = user_id_param),
+        'withdrawal_count', (select count(*) from withdrawals where user_id = user_id_param)
+    )
+    from users u
+    where u.id = user_id_param;
+$$;
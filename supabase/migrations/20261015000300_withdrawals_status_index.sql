@@ -0,0 +1,5 @@
+-- Serves the payout processor's keyset scan over approved withdrawals
+-- (status = 'approved' order by created_at, id) and the stuck-processing sweep.
+create index if not exists idx_withdrawals_status_created
+    on withdrawals (status, created_at, id)
+    where status in ('approved', 'processing');
@@ -0,0 +1,20 @@
+-- Atomically claim the oldest approved withdrawals for payout. FOR UPDATE
+-- SKIP LOCKED lets several processors run side by side without ever
+-- claiming the same row; the claimed rows are returned in full.
+create or replace function claim_approved_withdrawals(limit_param int)
+returns setof withdrawals
+language sql
+as $$
+    update withdrawals w
+       set status = 'processing',
+           processed_at = now()
+     where w.id in (
+         select id
+           from withdrawals
+          where status = 'approved'
+          order by created_at, id
+          limit limit_param
+          for update skip locked
+     )
+    returning w.*;
+$$;
@@ -0,0 +1,58 @@
+-- Record a payout batch's outcomes in one transaction. items is a JSON array
+-- of {id, status, tx_hash, admin_note} objects with status 'paid' or 'failed'.
+-- Paid rows get their tx_hash and a withdrawal_paid transaction; failed rows
+-- get their admin_note and are refunded through add_balance, so a status
+-- change can never be committed without its matching ledger entry. Only rows
+-- still in processing are touched, so a row another path already settled is
+-- never paid or refunded twice.
+create or replace function finalize_withdrawals(items jsonb, network_param text)
+returns void
+language plpgsql
+as $$
+declare
+    item jsonb;
+    w withdrawals;
+begin
+    for item in select * from jsonb_array_elements(items)
+    loop
+        if item->>'status' = 'paid' then
+            update withdrawals
+               set status = 'paid',
+                   tx_hash = item->>'tx_hash',
+                   processed_at = now(),
+                   network = network_param
+             where id = (item->>'id')::bigint
+               and status = 'processing'
+            returning * into w;
+
+            if not found then
+                continue;
+            end if;
+
+            insert into transactions (user_id, type, amount, description, reference_id)
+            values (w.user_id, 'withdrawal_paid', -(w.amount::numeric),
+                    'Withdrawal paid on ' || network_param || ' - TX: ' || w.tx_hash, w.id);
+        else
+            update withdrawals
+               set status = 'failed',
+                   admin_note = item->>'admin_note',
+                   processed_at = now(),
+                   network = network_param
+             where id = (item->>'id')::bigint
+               and status = 'processing'
+            returning * into w;
+
+            if not found then
+                continue;
+            end if;
+
+            perform add_balance(
+                user_id_param => w.user_id,
+                amount_param => w.amount,
+                type_param => 'refund',
+                description_param => 'Refund for failed withdrawal #' || w.id
+            );
+        end if;
+    end loop;
+end;
+$$;
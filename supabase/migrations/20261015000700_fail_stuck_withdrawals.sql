@@ -0,0 +1,39 @@
+-- Fail and refund withdrawals stuck in processing for longer than
+-- cutoff_minutes, in one transaction. Rows that already carry a tx_hash were
+-- broadcast and may have paid out, so they are only counted for review.
+create or replace function fail_stuck_withdrawals(cutoff_minutes int)
+returns json
+language plpgsql
+as $$
+declare
+    w record;
+    failed int := 0;
+    needs_review int;
+begin
+    select count(*) into needs_review
+      from withdrawals
+     where status = 'processing'
+       and processed_at < now() - make_interval(mins => cutoff_minutes)
+       and tx_hash is not null;
+
+    for w in
+        update withdrawals
+           set status = 'failed',
+               admin_note = 'Stuck in processing - auto-failed'
+         where status = 'processing'
+           and processed_at < now() - make_interval(mins => cutoff_minutes)
+           and tx_hash is null
+        returning id, user_id, amount
+    loop
+        perform add_balance(
+            user_id_param => w.user_id,
+            amount_param => w.amount,
+            type_param => 'refund',
+            description_param => 'Auto-refund for stuck withdrawal #' || w.id
+        );
+        failed := failed + 1;
+    end loop;
+
+    return json_build_object('failed', failed, 'needs_review', needs_review);
+end;
+$$;